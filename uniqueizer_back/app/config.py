@@ -5,8 +5,27 @@ from pathlib import Path
 class Settings(BaseSettings):
     upload_dir: Path = Path("./uploads")
     output_dir: Path = Path("./outputs")
+    scratch_dir: Path = Path("./scratch")  # Быстрый диск/tmpfs для промежуточных файлов
     max_file_size: int = 10 * 1024 * 1024 * 1024  # 10GB
     temp_file_cleanup_hours: int = 24  # Удалять файлы старше 24 часов
+    encode_slots: int = 4  # Слотов кодирования на весь сервер (сервер работает одним воркером uvicorn)
+    encode_batch_size: int = 4  # Сколько копий кодировать одним процессом FFmpeg
+    audio_pool_size: int = 3  # Вариантов аудио на задачу (0 - кодировать аудио в каждой копии)
+    segment_encoder_threads: int = 8  # Потоков x264 на один параллельный сегмент
+    segment_min_duration: int = 60  # Минимальная длина сегмента (сек)
+    
+    max_copies_count: int = 100  # Лимит копий для обычных режимов
+    max_combinatorial_copies: int = 5000  # Лимит копий для combinatorial
+    variant_max_segments: int = 8  # Максимум сегментов S в combinatorial
+    variant_min_segment_duration: int = 2  # Минимальная длина сегмента (сек)
+    
+    mezzanine_enabled: bool = True  # Декодировать дорогой вход один раз в FFV1
+    mezzanine_decode_ratio: float = 0.35  # Стоимость декодирования FFV1 относительно источника
+    geometry_cost_budget: float = 250.0  # Бюджет фильтра геометрии: стоимость * мегапикселей/сек
+    # Раскладка MP4/MOV: reserved - место под moov в начале файла,
+    # fragmented - фрагментированный MP4, faststart - перезапись на scratch
+    output_layout: str = "reserved"
+    lazy_cache_bytes: int = 20 * 1024 * 1024 * 1024  # Бюджет кеша копий, собранных по запросу (20GB)
     
     backend_port: int = 8000
     frontend_port: int = 80
@@ -19,3 +38,4 @@ settings = Settings()
 # Создаем директории если их нет
 settings.upload_dir.mkdir(exist_ok=True)
 settings.output_dir.mkdir(exist_ok=True)
+settings.scratch_dir.mkdir(exist_ok=True)
@@ -1,7 +1,9 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Form, Header, Request
 from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
+import hashlib
 import uuid
 from typing import Optional
 import logging
@@ -9,7 +11,10 @@ import subprocess
 import shutil
 
 from app.config import settings
-from app.models import ProcessStatus, ProcessResult
+from app.models import (
+    ProcessStatus, ProcessResult, ProcessingTier, SpeedClass, RateControl, OutputProfile, Delivery,
+    PriorityClass
+)
 from app.services.video_processor import VideoProcessor
 from app.utils.file_handler import save_upload_file, cleanup_file
 
@@ -76,6 +81,7 @@ async def shutdown_event():
     Действия при остановке
     """
     logger.info("👋 Shutting down Video Uniquifier API")
+    processor.encode_pool.shutdown()
 
 
 @app.get("/")
@@ -90,17 +96,49 @@ async def root():
     }
 
 
+def client_key(request: Request, api_key: Optional[str]) -> str:
+    """
+    Ключ клиента для справедливой очереди: хеш API-ключа, если он
+    передан, иначе IP-адрес
+    """
+    if api_key:
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:16]}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
 @app.post("/api/upload", response_model=ProcessStatus)
 async def upload_video(
+    request: Request,
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    copies_count: int = Form(..., ge=1, le=100),  # Добавлено ... для обязательного поля
-    output_format: str = Form(default="mp4")
+    copies_count: int = Form(..., ge=1, le=settings.max_combinatorial_copies),  # Добавлено ... для обязательного поля
+    output_format: str = Form(default="mp4"),
+    tier: ProcessingTier = Form(default=ProcessingTier.FULL),
+    speed_class: SpeedClass = Form(default=SpeedClass.BALANCED),
+    rate_control: RateControl = Form(default=RateControl.CRF),
+    target_bitrate_kbps: Optional[int] = Form(default=None, ge=100),
+    max_bitrate_kbps: Optional[int] = Form(default=None, ge=100),
+    max_size_percent: Optional[float] = Form(default=None, gt=0, le=1000),
+    output_profile: OutputProfile = Form(default=OutputProfile.SOURCE),
+    start: Optional[float] = Form(default=None, ge=0),  # Начало фрагмента (сек)
+    duration: Optional[float] = Form(default=None, gt=0),  # Длина фрагмента (сек)
+    delivery: Delivery = Form(default=Delivery.ARCHIVE),
+    priority: PriorityClass = Form(default=PriorityClass.STANDARD),
+    x_api_key: Optional[str] = Header(default=None)
 ):
     """
     Загружает видео и запускает процесс уникализации
     """
-    logger.info(f"Received upload request: {file.filename}, copies: {copies_count}")
+    logger.info(f"Received upload request: {file.filename}, copies: {copies_count}, tier: {tier.value}, speed: {speed_class.value}")
+    
+    # Тысячи копий доступны только при комбинаторной сборке. Выдача по
+    # запросу всегда кодирует копии полностью, какой бы режим ни запросили
+    effective_tier = ProcessingTier.FULL if delivery in (Delivery.LAZY, Delivery.STREAM) else tier
+    if effective_tier != ProcessingTier.COMBINATORIAL and copies_count > settings.max_copies_count:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Максимум {settings.max_copies_count} копий, больше - только в режиме combinatorial"
+        )
     
     # Проверка формата файла
     allowed_extensions = {'.mp4', '.mov', '.avi', '.mkv', '.webm'}
@@ -130,7 +168,19 @@ async def upload_video(
         task_id = await processor.process_video(
             temp_file,
             copies_count,
-            output_format
+            output_format,
+            tier,
+            speed_class,
+            rate_control,
+            target_bitrate_kbps,
+            max_bitrate_kbps,
+            max_size_percent,
+            output_profile,
+            start,
+            duration,
+            delivery,
+            client_key(request, x_api_key),
+            priority
         )
         
         logger.info(f"Processing started with task_id: {task_id}")
@@ -140,9 +190,12 @@ async def upload_video(
             status="processing",
             progress=0,
             total_copies=copies_count,
+            tier=tier,
+            delivery=delivery,
+            priority=priority,
             message="Обработка началась"
         )
-        
+    
     except Exception as e:
         logger.error(f"Upload error: {str(e)}", exc_info=True)
         cleanup_file(temp_file)
@@ -200,12 +253,21 @@ async def get_status(task_id: str):
         raise HTTPException(status_code=404, detail="Задача не найдена")
     
     # Задача есть в памяти - возвращаем ее статус
+    queue_wait = task.get('queue_wait')
     return ProcessStatus(
         task_id=task_id,
         status=task['status'],
         progress=task['progress'],
         total_copies=task.get('total', 10),
-        message=task.get('error')
+        tier=task.get('tier'),
+        delivery=task.get('delivery'),
+        priority=task.get('priority'),
+        message=task.get('error'),
+        queue_wait_seconds=(
+            round(queue_wait['total_seconds'] / queue_wait['items'], 2) if queue_wait else None
+        ),
+        max_queue_wait_seconds=round(queue_wait['max_seconds'], 2) if queue_wait else None,
+        estimated_seconds=task.get('estimated_seconds')
     )
 
 
@@ -236,7 +298,8 @@ async def get_result(task_id: str):
         task_id=task_id,
         status=task['status'],
         files=task['files'],
-        archive_url=archive_url
+        archive_url=archive_url,
+        sizes=task.get('sizes', [])
     )
 
 
@@ -259,7 +322,7 @@ def cleanup_task_after_download(task_id: str):
         if task_id in processor.active_tasks:
             del processor.active_tasks[task_id]
             logger.info(f"Removed task {task_id} from active tasks")
-            
+    
     except Exception as e:
         logger.error(f"Error cleaning up task {task_id}: {str(e)}", exc_info=True)
 
@@ -319,7 +382,8 @@ async def download_archive(task_id: str, background_tasks: BackgroundTasks):
 @app.get("/api/download/{task_id}/{filename}")
 async def download_file(task_id: str, filename: str):
     """
-    Скачивает отдельный файл
+    Скачивает отдельный файл. Копия задачи с отложенной сборкой
+    кодируется при первом запросе
     """
     logger.info(f"Download request: task={task_id}, file={filename}")
     
@@ -330,8 +394,24 @@ async def download_file(task_id: str, filename: str):
         raise HTTPException(status_code=404, detail="Задача не найдена")
     
     file_path = task_dir / filename
+    release = None
+    
+    # Задача с отложенной сборкой: копия кодируется при первом запросе и
+    # закреплена в кеше, пока ответ не отдан
+    task = processor.get_on_demand_task(task_id)
+    if task and task.get('delivery') == Delivery.LAZY:
+        try:
+            materialized = await processor.materialize_copy(task_id, filename)
+        except RuntimeError as e:
+            logger.error(f"On-demand encode failed: {str(e)}")
+            raise HTTPException(status_code=500, detail="Не удалось собрать копию")
+        if materialized:
+            file_path = materialized
+            release = BackgroundTask(processor.release_copy, materialized)
     
     if not file_path.exists():
+        if release:
+            processor.release_copy(file_path)
         logger.error(f"File not found: {file_path}")
         raise HTTPException(status_code=404, detail="Файл не найден")
     
@@ -340,7 +420,36 @@ async def download_file(task_id: str, filename: str):
     return FileResponse(
         path=file_path,
         filename=filename,
-        media_type='application/octet-stream'
+        media_type='application/octet-stream',
+        background=release
+    )
+
+
+@app.get("/api/stream/{task_id}/{copy_number}")
+async def stream_copy(task_id: str, copy_number: int):
+    """
+    Кодирует копию по запросу и отдает ее фрагментированным MP4
+    прямо из stdout FFmpeg, не сохраняя на диск
+    """
+    task = processor.get_on_demand_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    if not 1 <= copy_number <= task['total']:
+        raise HTTPException(status_code=404, detail="Копия не найдена")
+    
+    chunks = await processor.stream_copy(task_id, copy_number)
+    if chunks is None:
+        raise HTTPException(status_code=400, detail="Задача не в режиме потоковой выдачи или еще не готова")
+    
+    logger.info(f"Streaming copy {copy_number} of task {task_id}")
+    
+    filename = f"video_{copy_number:03d}.mp4"
+    return StreamingResponse(
+        chunks,
+        media_type='video/mp4',
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"'
+        }
     )
 
 
@@ -357,6 +466,7 @@ async def delete_task(task_id: str):
         freed_space = sum(f.stat().st_size for f in task_dir.rglob('*') if f.is_file())
         
         shutil.rmtree(task_dir)
+        processor.copy_cache.discard_dir(task_dir)
         logger.info(f"Deleted task directory: {task_dir}, freed {freed_space / (1024*1024):.2f} MB")
     
     if task_id in processor.active_tasks:
@@ -393,6 +503,15 @@ async def get_storage_info():
     return storage_info
 
 
+@app.get("/api/cost-model")
+async def get_cost_model():
+    """
+    Откалиброванные скорости модели стоимости кодирования
+    (секунд на единицу работы копии по режимам)
+    """
+    return processor.cost_model.snapshot()
+
+
 @app.get("/api/health")
 async def health_check():
     """
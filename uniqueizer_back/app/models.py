@@ -2,6 +2,8 @@ from pydantic import BaseModel, Field
 from typing import List, Optional
 from enum import Enum
 
+from app.config import settings
+
 
 class VideoFormat(str, Enum):
     MP4 = "mp4"
@@ -10,9 +12,78 @@ class VideoFormat(str, Enum):
     MKV = "mkv"
 
 
+class ProcessingTier(str, Enum):
+    FULL = "full"  # Полное перекодирование
+    CONTAINER = "container"  # Только контейнер: ремукс без перекодирования
+    METADATA = "metadata"  # Патч атомов MP4/MOV без FFmpeg
+    BITSTREAM = "bitstream"  # SEI/VUI через bitstream-фильтры без перекодирования
+    SMART = "smart"  # Перекодирование только первых GOP, остальное копируется
+    COMBINATORIAL = "combinatorial"  # Копии собираются из вариантов сегментов
+
+
+class SpeedClass(str, Enum):
+    FAST = "fast"  # Быстрые пресеты, минимум CPU на копию
+    BALANCED = "balanced"  # fast/medium
+    QUALITY = "quality"  # slow/slower, в 2-3 раза дороже medium
+
+
+class OutputProfile(str, Enum):
+    SOURCE = "source"  # Разрешение источника
+    SOCIAL_1080P = "1080p_social"  # Короткая сторона до 1080, balanced
+    FAST_720P = "720p_fast"  # Короткая сторона до 720, быстрые пресеты
+
+
+class Delivery(str, Enum):
+    ARCHIVE = "archive"  # Все копии кодируются заранее и архивируются
+    STREAM = "stream"  # Копия кодируется при запросе прямо в HTTP-ответ
+    LAZY = "lazy"  # Хранятся параметры копий, копия кодируется при первом скачивании
+
+
+class PriorityClass(str, Enum):
+    INTERACTIVE = "interactive"  # Первыми из очереди, обычный приоритет CPU и диска
+    STANDARD = "standard"  # После interactive, nice 5
+    BULK = "bulk"  # Только свободные мощности: nice 15, ionice idle
+
+
+class RateControl(str, Enum):
+    CRF = "crf"  # Постоянное качество, размер не предсказуем
+    TWO_PASS = "two_pass"  # Целевой битрейт, первый проход общий на задачу
+
+
 class ProcessRequest(BaseModel):
-    copies_count: int = Field(ge=1, le=100, description="Количество копий от 1 до 100")
+    copies_count: int = Field(
+        ge=1,
+        le=settings.max_combinatorial_copies,
+        description=(
+            f"Количество копий: до {settings.max_copies_count}, "
+            f"для combinatorial до {settings.max_combinatorial_copies}"
+        )
+    )
     output_format: VideoFormat = VideoFormat.MP4
+    tier: ProcessingTier = ProcessingTier.FULL
+    speed_class: SpeedClass = SpeedClass.BALANCED
+    output_profile: OutputProfile = OutputProfile.SOURCE
+    rate_control: RateControl = RateControl.CRF
+    target_bitrate_kbps: Optional[int] = Field(
+        default=None,
+        ge=100,
+        description="Целевой битрейт видео для two_pass, по умолчанию битрейт входа"
+    )
+    max_bitrate_kbps: Optional[int] = Field(
+        default=None,
+        ge=100,
+        description="Максимальный битрейт копии (видео + аудио), ограничивается VBV"
+    )
+    max_size_percent: Optional[float] = Field(
+        default=None,
+        gt=0,
+        le=1000,
+        description="Максимальный размер копии в процентах от размера входа"
+    )
+    delivery: Delivery = Delivery.ARCHIVE
+    priority: PriorityClass = PriorityClass.STANDARD
+    start: Optional[float] = Field(default=None, ge=0, description="Начало фрагмента (сек)")
+    duration: Optional[float] = Field(default=None, gt=0, description="Длина фрагмента (сек)")
 
 
 class ProcessStatus(BaseModel):
@@ -20,7 +91,19 @@ class ProcessStatus(BaseModel):
     status: str
     progress: int
     total_copies: int
+    tier: Optional[ProcessingTier] = None
+    delivery: Optional[Delivery] = None
+    priority: Optional[PriorityClass] = None
     message: Optional[str] = None
+    queue_wait_seconds: Optional[float] = None  # Среднее ожидание копии в очереди кодирования
+    max_queue_wait_seconds: Optional[float] = None
+    estimated_seconds: Optional[float] = None  # Предсказанное время кодирования всех копий
+
+
+class CopySize(BaseModel):
+    file: str
+    size_bytes: int
+    target_bytes: Optional[int] = None  # Лимит размера, если задан
 
 
 class ProcessResult(BaseModel):
@@ -28,3 +111,4 @@ class ProcessResult(BaseModel):
     status: str
     files: List[str]
     archive_url: Optional[str] = None
+    sizes: List[CopySize] = []
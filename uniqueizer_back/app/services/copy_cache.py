@@ -0,0 +1,86 @@
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.utils.file_handler import cleanup_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class CopyCache:
+    """
+    LRU-кеш копий, собранных по запросу: при превышении бюджета байт
+    удаляются копии, которые дольше всех не скачивали. Копию всегда можно
+    собрать заново по сохраненным параметрам. Копии, которые сейчас
+    отдаются клиентам (закреплены), не вытесняются
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # Путь копии -> размер, от давно не использованных к свежим
+        self.entries: "OrderedDict[Path, int]" = OrderedDict()
+        # Путь копии -> сколько ответов ее сейчас отдают
+        self.pins: Dict[Path, int] = {}
+    
+    def touch(self, path: Path) -> bool:
+        """
+        Отмечает копию как использованную
+        
+        Returns:
+            False если копии нет в кеше
+        """
+        if path not in self.entries:
+            return False
+        self.entries.move_to_end(path)
+        return True
+    
+    def add(self, path: Path):
+        """
+        Добавляет собранную копию и вытесняет старые, пока не уложимся
+        в бюджет (только что добавленная копия не вытесняется)
+        """
+        self.discard(path)
+        size = path.stat().st_size
+        self.entries[path] = size
+        self.total_bytes += size
+        self._evict(keep=path)
+    
+    def pin(self, path: Path):
+        """Закрепляет копию на время отдачи клиенту"""
+        self.pins[path] = self.pins.get(path, 0) + 1
+    
+    def unpin(self, path: Path):
+        """Снимает закрепление после отдачи и досрочно вытесняет лишнее"""
+        count = self.pins.pop(path, 0) - 1
+        if count > 0:
+            self.pins[path] = count
+        self._evict()
+    
+    def _evict(self, keep: Optional[Path] = None):
+        """
+        Удаляет незакрепленные копии от давно не использованных к свежим,
+        пока кеш не уложится в бюджет
+        """
+        for old_path in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if old_path == keep or old_path in self.pins:
+                continue
+            old_size = self.entries.pop(old_path)
+            self.total_bytes -= old_size
+            cleanup_file(old_path)
+            logger.info(f"Evicted {old_path} from copy cache ({old_size} bytes)")
+    
+    def discard(self, path: Path):
+        """Убирает копию из учета (файл не трогает)"""
+        size = self.entries.pop(path, None)
+        if size is not None:
+            self.total_bytes -= size
+    
+    def discard_dir(self, directory: Path):
+        """Убирает из учета все копии удаленной задачи"""
+        for path in [path for path in self.entries if path.parent == directory]:
+            self.discard(path)
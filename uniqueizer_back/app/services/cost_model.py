@@ -0,0 +1,70 @@
+from typing import Dict
+
+
+# Начальная оценка секунд на единицу работы копии (относительная стоимость
+# кодирования * мегапиксели кадра * число кадров, см. _estimate_cost).
+# Дальше модель калибруется по замерам реальных копий
+DEFAULT_SECONDS_PER_UNIT = {
+    'full': 0.01,
+    'smart': 0.002,  # перекодируются только несколько GOP
+    'combinatorial': 0.0003,  # склейка готовых вариантов
+    'bitstream': 0.0003,
+    'container': 0.0003,
+    'metadata': 0.00002,  # патч атомов, без FFmpeg
+}
+
+# Постоянная часть времени копии: запуск FFmpeg, проба, запись контейнера
+COPY_OVERHEAD_SECONDS = 0.5
+
+# Вес нового замера в скользящем среднем
+CALIBRATION_ALPHA = 0.2
+
+
+class EncodeCostModel:
+    """
+    Предсказание времени кодирования копий: секунды = накладные расходы
+    на копию + скорость * единицы работы. Скорость своя для каждого
+    ключа (режим задачи, пачки, сегменты) и подстраивается под замеры
+    уже закодированных копий
+    """
+    
+    def __init__(self):
+        self.rates: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+    
+    def rate(self, key: str) -> float:
+        """
+        Секунд на единицу работы. Ключ без замеров берет начальную оценку
+        своего режима (часть ключа до ':')
+        """
+        if key in self.rates:
+            return self.rates[key]
+        return DEFAULT_SECONDS_PER_UNIT.get(key.split(':')[0], DEFAULT_SECONDS_PER_UNIT['full'])
+    
+    def predict(self, key: str, units: float, copies: int = 1) -> float:
+        """
+        Предсказанное время кодирования copies копий общей работой units (сек)
+        """
+        return COPY_OVERHEAD_SECONDS * copies + self.rate(key) * max(0.0, units)
+    
+    def observe(self, key: str, units: float, copies: int, seconds: float):
+        """
+        Калибрует скорость ключа по замеренному времени кодирования
+        """
+        if units <= 0:
+            return
+        
+        measured = max(0.0, seconds - COPY_OVERHEAD_SECONDS * copies) / units
+        if key in self.rates:
+            self.rates[key] += CALIBRATION_ALPHA * (measured - self.rates[key])
+        else:
+            # Первый замер надежнее начальной оценки
+            self.rates[key] = measured
+        self.samples[key] = self.samples.get(key, 0) + 1
+    
+    def snapshot(self) -> Dict:
+        """Текущие скорости и число замеров по ключам"""
+        return {
+            key: {'seconds_per_unit': rate, 'samples': self.samples.get(key, 0)}
+            for key, rate in self.rates.items()
+        }
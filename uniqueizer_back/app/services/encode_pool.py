@@ -0,0 +1,200 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Deque, Dict, Optional
+
+from app.models import PriorityClass
+from app.services.process_priority import run_with_priority
+
+
+# Квант дефицитного round-robin: сколько секунд предсказанного
+# кодирования клиент получает за ход
+DRR_QUANTUM = 30.0
+
+# Старение: каждая секунда ожидания уменьшает ранг работы на столько секунд,
+# чтобы длинные задачи не голодали за потоком коротких
+AGING_RATE = 1.0
+
+
+class EncodePool:
+    """
+    Общий на процесс пул кодирования: одновременно идут работы общим
+    весом не больше slots, независимо от числа задач. Обычная копия весит
+    один слот, копия из K параллельных сегментов - K. Остальные работы
+    ждут в очереди. Один процесс сервера - один пул, поэтому сервер
+    запускается с одним воркером uvicorn. Кодирование идет в собственных потоках и не занимает
+    стандартный executor asyncio, которым пользуются архивация и файловый I/O
+    
+    Очередь справедливая: у каждого клиента своя очередь, а слоты
+    раздаются дефицитным round-robin (DRR) по стоимости работ, поэтому
+    небольшие задачи не ждут, пока закончится чужая задача на сотню копий.
+    Классы приоритета обслуживаются строго по порядку: bulk получает
+    слот, только когда interactive и standard ничего не ждут. Из очереди
+    клиента первой берется работа с наименьшим рангом (предсказанный
+    остаток задачи) с поправкой на время ожидания
+    """
+    
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self.executor = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix='encode')
+        # Класс -> клиент -> его очередь работ, в порядке обхода round-robin
+        self.queues: Dict[PriorityClass, "OrderedDict[str, Deque[Dict]]"] = {
+            priority: OrderedDict() for priority in PriorityClass
+        }
+        self.deficits: Dict[PriorityClass, Dict[str, float]] = {
+            priority: {} for priority in PriorityClass
+        }
+        self.running = 0
+        # Класс -> работа, выбранная очередью класса, но не поместившаяся в
+        # свободные слоты: запускается первой в своем классе, как только их
+        # станет достаточно. Старшие классы ее обходят
+        self.held: Dict[PriorityClass, Dict] = {}
+    
+    async def run(
+        self,
+        func: Callable,
+        *args,
+        client: str = 'default',
+        cost: float = 1.0,
+        stats: Optional[Dict] = None,
+        priority: PriorityClass = PriorityClass.STANDARD,
+        rank: float = 0.0,
+        observe: Optional[Callable[[float], None]] = None,
+        weight: int = 1
+    ):
+        """
+        Ставит кодирование в очередь клиента и ждет его результата
+        
+        Args:
+            func, args: что выполнить в потоке кодирования
+            client: ключ клиента для справедливого разделения слотов
+            cost: стоимость работы для DRR (предсказанные секунды кодирования)
+            stats: словарь задачи, куда копится время ожидания в очереди
+            priority: класс задачи - порядок в очереди и nice/ionice FFmpeg
+            rank: ключ кратчайшей работы - меньше значит раньше
+            observe: вызывается с замеренным временем выполнения (сек)
+            weight: сколько слотов занимает работа (не больше slots)
+        """
+        item = {
+            'future': asyncio.get_running_loop().create_future(),
+            'func': func,
+            'args': args,
+            'cost': cost,
+            'stats': stats,
+            'priority': priority,
+            'rank': rank,
+            'observe': observe,
+            'weight': min(max(1, weight), self.slots),
+            'queued_at': time.monotonic(),
+        }
+        queues = self.queues[priority]
+        if client not in queues:
+            queues[client] = deque()
+            # Новый клиент сразу получает квант
+            self.deficits[priority][client] = DRR_QUANTUM
+        queues[client].append(item)
+        self._dispatch()
+        return await item['future']
+    
+    def free_slots(self, priority: PriorityClass = PriorityClass.STANDARD) -> int:
+        """
+        Сколько слотов свободно для работы класса priority с учетом уже
+        ждущих работ того же и старших классов (младшие она обгонит)
+        """
+        ahead = list(PriorityClass)[:list(PriorityClass).index(priority) + 1]
+        waiting = sum(
+            len(queue) for cls in ahead for queue in self.queues[cls].values()
+        ) + sum(self.held[cls]['weight'] for cls in ahead if cls in self.held)
+        return max(0, self.slots - self.running - waiting)
+    
+    def _dispatch(self):
+        """
+        Запускает ждущие работы, пока есть свободные слоты. Тяжелая работа
+        не обгоняется легкими работами своего и младших классов: пока для
+        нее не освободится достаточно слотов, они не запускаются. Старшие
+        классы запускаются в оставшиеся слоты
+        """
+        loop = asyncio.get_running_loop()
+        while self.running < self.slots:
+            priority = next(
+                (cls for cls in PriorityClass if cls in self.held or self.queues[cls]),
+                None
+            )
+            if priority is None:
+                break
+            
+            item = self.held.pop(priority, None) or self._next_item(priority)
+            if item['future'].cancelled():
+                continue  # ожидающий отменен - кодировать незачем
+            if self.running + item['weight'] > self.slots:
+                self.held[priority] = item
+                break
+            
+            if item['stats'] is not None:
+                self._record_wait(item['stats'], time.monotonic() - item['queued_at'])
+            
+            self.running += item['weight']
+            item['started_at'] = time.monotonic()
+            future = loop.run_in_executor(
+                self.executor, run_with_priority, item['priority'], item['func'], *item['args']
+            )
+            future.add_done_callback(partial(self._finish, item))
+    
+    def _next_item(self, priority: PriorityClass) -> Dict:
+        """
+        Следующая работа класса: DRR - клиент в голове обхода забирает работы, пока хватает
+        дефицита, затем уходит в конец и получает квант. Опустевшая
+        очередь удаляется вместе с накопленным дефицитом
+        """
+        queues = self.queues[priority]
+        deficits = self.deficits[priority]
+        
+        while True:
+            client, queue = next(iter(queues.items()))
+            item = self._shortest_item(queue)
+            if item['cost'] <= deficits[client]:
+                queue.remove(item)
+                deficits[client] -= item['cost']
+                if not queue:
+                    del queues[client]
+                    del deficits[client]
+                return item
+            
+            queues.move_to_end(client)
+            deficits[client] += DRR_QUANTUM
+    
+    def _shortest_item(self, queue: Deque[Dict]) -> Dict:
+        """
+        Работа с наименьшим рангом после старения
+        """
+        now = time.monotonic()
+        return min(queue, key=lambda item: item['rank'] - AGING_RATE * (now - item['queued_at']))
+    
+    def _record_wait(self, stats: Dict, waited: float):
+        """Копит время ожидания работ задачи в очереди"""
+        stats['items'] = stats.get('items', 0) + 1
+        stats['total_seconds'] = stats.get('total_seconds', 0.0) + waited
+        stats['max_seconds'] = max(stats.get('max_seconds', 0.0), waited)
+    
+    def _finish(self, item: Dict, future: asyncio.Future):
+        """
+        Освобождает слоты работы, передает результат ожидающему и
+        запускает следующие работы
+        """
+        self.running -= item['weight']
+        if item['observe'] is not None and not future.cancelled() and future.exception() is None:
+            item['observe'](time.monotonic() - item['started_at'])
+        if future.cancelled():
+            item['future'].cancel()
+        elif not item['future'].cancelled():
+            if future.exception():
+                item['future'].set_exception(future.exception())
+            else:
+                item['future'].set_result(future.result())
+        self._dispatch()
+    
+    def shutdown(self):
+        """Останавливает потоки кодирования"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,320 @@
+import json
+import subprocess
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+# Сколько результатов анализа держать в памяти
+ANALYSIS_CACHE_SIZE = 256
+
+# Контейнеры, где позиция пакета указывает на сэмпл с NAL в формате
+# длина (4 байта) + NAL - только в них тип ключевого кадра читается напрямую
+LENGTH_PREFIXED_EXTENSIONS = {'.mp4', '.mov', '.m4v'}
+NAL_LENGTH_SIZE = 4
+
+# Кэш анализа: ключ файла -> результат analyze_media
+_analysis_cache: "OrderedDict[str, Dict]" = OrderedDict()
+_analysis_lock = threading.Lock()
+
+
+def probe_media(input_path: Path) -> Dict:
+    """
+    Запускает ffprobe и возвращает описание потоков и контейнера
+    
+    Returns:
+        Словарь с ключами 'streams' и 'format' (пустые при ошибке)
+    """
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_streams',
+        '-show_format',
+        '-of', 'json',
+        str(input_path),
+    ]
+    
+    try:
+        result = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        info = json.loads(result.stdout or '{}')
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print(f"FFprobe error: {e}")
+        info = {}
+    
+    return {
+        'streams': info.get('streams', []),
+        'format': info.get('format', {}),
+    }
+
+
+def get_stream(info: Dict, codec_type: str) -> Optional[Dict]:
+    """Возвращает первый поток указанного типа (video/audio)"""
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == codec_type:
+            return stream
+    return None
+
+
+def has_audio_stream(info: Dict) -> bool:
+    """Проверяет наличие аудио дорожки"""
+    return get_stream(info, 'audio') is not None
+
+
+def probe_keyframes(input_path: Path) -> List[float]:
+    """
+    Пакетная проба видеопотока без декодирования: возвращает
+    отсортированные времена (pts, секунды) ключевых кадров
+    """
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        str(input_path),
+    ]
+    
+    try:
+        result = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"FFprobe error: {e.stderr}")
+        return []
+    
+    keyframes = set()
+    for line in result.stdout.splitlines():
+        parts = line.strip().split(',')
+        if len(parts) < 2 or 'K' not in parts[1]:
+            continue
+        try:
+            keyframes.add(float(parts[0]))
+        except ValueError:
+            continue  # pts_time=N/A
+    
+    return sorted(keyframes)
+
+
+def probe_clean_keyframes(input_path: Path, codec_name: Optional[str]) -> List[float]:
+    """
+    Ключевые кадры, по которым поток можно резать без потери опорных
+    кадров: IDR (H.264) или IRAP (HEVC) по типу первого слайса сэмпла и
+    без leading-кадров - ни один следующий в порядке декодирования пакет
+    не показывается раньше ключевого. Кадры open GOP и кадры, тип которых
+    не удалось прочитать, пропускаются
+    
+    Returns:
+        Отсортированные времена (pts, секунды); пусто если контейнер или
+        кодек не позволяют проверить точки разреза
+    """
+    if input_path.suffix.lower() not in LENGTH_PREFIXED_EXTENSIONS:
+        return []
+    if codec_name not in ('h264', 'hevc'):
+        return []
+    
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,size,pos,flags',
+        '-of', 'compact=p=0',
+        str(input_path),
+    ]
+    
+    try:
+        result = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"FFprobe error: {e.stderr}")
+        return []
+    
+    # Пакеты в порядке декодирования: (pts, позиция, размер, ключевой)
+    packets = []
+    for line in result.stdout.splitlines():
+        fields = dict(field.split('=', 1) for field in line.strip().split('|') if '=' in field)
+        try:
+            pts = float(fields['pts_time'])
+            position = int(fields['pos'])
+            size = int(fields['size'])
+        except (KeyError, ValueError):
+            return []  # без pts или позиции пакета проверить разрез нельзя
+        packets.append((pts, position, size, 'K' in fields.get('flags', '')))
+    
+    clean = []
+    later_min = float('inf')
+    with open(input_path, 'rb') as f:
+        for pts, position, size, key in reversed(packets):
+            if key and later_min >= pts and _is_clean_random_access(f, position, size, codec_name):
+                clean.append(pts)
+            later_min = min(later_min, pts)
+    
+    return sorted(clean)
+
+
+def _is_clean_random_access(f, position: int, size: int, codec_name: str) -> bool:
+    """
+    Тип первого слайса сэмпла: IDR для H.264, IRAP (IDR, BLA, CRA) для
+    HEVC. Разбор должен ровно покрыть сэмпл, иначе формат не тот
+    """
+    offset = 0
+    first_vcl = None
+    while offset < size:
+        f.seek(position + offset)
+        header = f.read(NAL_LENGTH_SIZE + 1)
+        if len(header) < NAL_LENGTH_SIZE + 1:
+            return False
+        length = int.from_bytes(header[:NAL_LENGTH_SIZE], 'big')
+        if length == 0 or offset + NAL_LENGTH_SIZE + length > size:
+            return False
+        
+        if codec_name == 'h264':
+            nal_type = header[NAL_LENGTH_SIZE] & 0x1F
+            is_vcl = 1 <= nal_type <= 5
+        else:
+            nal_type = (header[NAL_LENGTH_SIZE] >> 1) & 0x3F
+            is_vcl = nal_type <= 31
+        if is_vcl and first_vcl is None:
+            first_vcl = nal_type
+        offset += NAL_LENGTH_SIZE + length
+    
+    if offset != size or first_vcl is None:
+        return False
+    if codec_name == 'h264':
+        return first_vcl == 5
+    return 16 <= first_vcl <= 21
+
+
+def get_start_time(info: Dict) -> float:
+    """Время начала файла (format.start_time), 0 если неизвестно"""
+    try:
+        return float(info.get('format', {}).get('start_time', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def get_duration(info: Dict) -> float:
+    """Длительность файла в секундах, 0 если неизвестна"""
+    try:
+        return float(info.get('format', {}).get('duration', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+
+def file_key(input_path: Path) -> str:
+    """
+    Ключ файла для кэша анализа: устройство, inode, размер и время
+    изменения. Перенос файла в пределах диска ключ не меняет, а любая
+    перезапись или другой файл - меняют. Это не хеш содержимого:
+    одинаковые по содержимому загрузки анализируются каждая отдельно
+    """
+    stat = input_path.stat()
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def parse_frame_rate(rate: Optional[str]) -> float:
+    """Переводит '30000/1001' в число кадров в секунду, 0 если неизвестно"""
+    try:
+        num, den = (rate or '0/1').split('/')
+        return float(num) / float(den)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def analyze_media(input_path: Path, with_keyframes: bool = False) -> Dict:
+    """
+    Анализ входа одним ffprobe с кэшем по ключу файла.
+    Результат содержит 'streams'/'format' (как probe_media) и сводку:
+    кодеки, размер кадра, FPS, длительность, битность, наличие аудио
+    
+    Args:
+        input_path: путь к файлу
+        with_keyframes: дополнительно (один раз) собрать времена ключевых кадров
+    
+    Returns:
+        Словарь анализа; общий для всех вызовов - не изменять
+    """
+    key = file_key(input_path)
+    
+    with _analysis_lock:
+        analysis = _analysis_cache.get(key)
+        if analysis is not None:
+            _analysis_cache.move_to_end(key)
+    
+    if analysis is None:
+        info = probe_media(input_path)
+        video_stream = get_stream(info, 'video') or {}
+        audio_stream = get_stream(info, 'audio') or {}
+        pixel_format = video_stream.get('pix_fmt') or ''
+        
+        try:
+            bit_depth = int(video_stream.get('bits_per_raw_sample') or 0)
+        except ValueError:
+            bit_depth = 0
+        if not bit_depth:
+            bit_depth = 12 if '12' in pixel_format else 10 if '10' in pixel_format else 8
+        
+        analysis = {
+            'streams': info['streams'],
+            'format': info['format'],
+            'file_key': key,
+            'has_audio': bool(audio_stream),
+            'video_codec': video_stream.get('codec_name'),
+            'audio_codec': audio_stream.get('codec_name'),
+            'width': int(video_stream.get('width') or 0),
+            'height': int(video_stream.get('height') or 0),
+            'fps': parse_frame_rate(video_stream.get('avg_frame_rate'))
+            or parse_frame_rate(video_stream.get('r_frame_rate')),
+            'frame_rate': video_stream.get('r_frame_rate'),
+            'pix_fmt': pixel_format,
+            'bit_depth': bit_depth,
+            'duration': get_duration(info),
+            'start_time': get_start_time(info),
+            'bit_rate': int(info['format'].get('bit_rate') or 0),
+        }
+        
+        with _analysis_lock:
+            _analysis_cache[key] = analysis
+            while len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+                _analysis_cache.popitem(last=False)
+    
+    if with_keyframes and 'keyframes' not in analysis:
+        # Выданные раньше словари не меняются: в кэш кладется новый
+        analysis = dict(analysis, keyframes=probe_keyframes(input_path))
+        with _analysis_lock:
+            if key in _analysis_cache:
+                _analysis_cache[key] = analysis
+    
+    return analysis
+
+
+def apply_window(media: Dict, window: Optional[Dict]) -> Dict:
+    """
+    Анализ входа в пределах окна задачи: длительность окна, ключевые
+    кадры внутри окна со временем от его начала
+    """
+    if not window:
+        return media
+    
+    windowed = dict(media, duration=window['duration'], start_time=0.0)
+    if 'keyframes' in media:
+        begin = media['start_time'] + window['start']
+        windowed['keyframes'] = [
+            keyframe - begin
+            for keyframe in media['keyframes']
+            if begin <= keyframe < begin + window['duration']
+        ]
+    return windowed
@@ -0,0 +1,125 @@
+import shutil
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.config import settings
+from app.services.process_priority import with_priority
+
+
+# Кодеки, декодирование которых дорого по сравнению с FFV1
+EXPENSIVE_CODECS = {'hevc', 'av1', 'vp9', 'prores'}
+
+# Длительность пробного декодирования (сек)
+SAMPLE_DURATION = 10
+
+# Стоимость кодирования FFV1 относительно декодирования источника
+MEZZANINE_ENCODE_COST = 0.5
+
+
+def is_expensive_source(media: Dict) -> bool:
+    """
+    Дорогой ли вход для декодирования: HEVC/AV1/VP9/ProRes или
+    глубина цвета больше 8 бит
+    """
+    return media['video_codec'] in EXPENSIVE_CODECS or media['bit_depth'] > 8
+
+
+def measure_decode_seconds(input_path: Path, duration: float) -> float:
+    """
+    Декодирует начало видео и экстраполирует время полного декодирования
+    """
+    sample = min(duration, SAMPLE_DURATION)
+    command = [
+        'ffmpeg',
+        '-v', 'error',
+        '-t', str(sample),
+        '-i', str(input_path),
+        '-map', '0:v:0',
+        '-f', 'null',
+        '-',
+    ]
+    
+    started = time.monotonic()
+    subprocess.run(with_priority(command), capture_output=True, check=True)
+    elapsed = time.monotonic() - started
+    
+    return duration * elapsed / max(sample, 0.001)
+
+
+def estimate_mezzanine_bytes(media: Dict) -> int:
+    """
+    Грубая оценка размера FFV1: около половины несжатого 4:2:0
+    """
+    bytes_per_sample = 2 if media['bit_depth'] > 8 else 1
+    frame_bytes = media['width'] * media['height'] * 1.5 * bytes_per_sample
+    return int(frame_bytes * (media['fps'] or 30.0) * media['duration'] * 0.5)
+
+
+def should_use_mezzanine(media: Dict, input_path: Path, decode_passes: int) -> bool:
+    """
+    Окупится ли промежуточный файл: (проходы декодирования) * D * (1 - r)
+    должно превышать D * (1 + стоимость кодирования FFV1), где D - время
+    полного декодирования источника, измеренное на пробном отрезке, а r -
+    относительная стоимость декодирования FFV1
+    """
+    if not settings.mezzanine_enabled or decode_passes < 2:
+        return False
+    if not is_expensive_source(media):
+        return False
+    
+    duration = media['duration']
+    if duration <= 0:
+        return False
+    
+    if estimate_mezzanine_bytes(media) > shutil.disk_usage(settings.scratch_dir).free * 0.8:
+        print("Not enough scratch space for mezzanine")
+        return False
+    
+    decode_seconds = measure_decode_seconds(input_path, duration)
+    savings = decode_passes * decode_seconds * (1 - settings.mezzanine_decode_ratio)
+    cost = decode_seconds * (1 + MEZZANINE_ENCODE_COST)
+    
+    print(f"Mezzanine estimate: decode {decode_seconds:.1f}s, savings {savings:.1f}s, cost {cost:.1f}s")
+    return savings > cost
+
+
+def create_mezzanine(input_path: Path, output_path: Path, window: Optional[Dict] = None) -> bool:
+    """
+    Декодирует вход (или только окно задачи) один раз в FFV1 (только
+    I-кадры, слайсы для многопоточного декодирования), аудио копируется
+    без изменений
+    """
+    command = ['ffmpeg']
+    if window:
+        command.extend([
+            '-ss', f"{window['start']:.6f}",
+            '-t', f"{window['duration']:.6f}",
+        ])
+    command.extend([
+        '-i', str(input_path),
+        '-y',
+        '-map', '0:v:0',
+        '-map', '0:a?',
+        '-c:v', 'ffv1',
+        '-level', '3',
+        '-g', '1',
+        '-slices', '16',
+        '-slicecrc', '0',
+        '-c:a', 'copy',
+        str(output_path),
+    ])
+    
+    try:
+        subprocess.run(
+            with_priority(command),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return output_path.exists()
+    except subprocess.CalledProcessError as e:
+        print(f"FFmpeg mezzanine error: {e.stderr}")
+        output_path.unlink(missing_ok=True)
+        return False
@@ -0,0 +1,343 @@
+import os
+import shutil
+import struct
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# ioctl FICLONE (reflink) из linux/fs.h
+FICLONE = 0x40049409
+
+# Секунд между эпохой MP4 (1904-01-01) и Unix (1970-01-01)
+MP4_EPOCH_OFFSET = 2082844800
+
+# Атомы-контейнеры, внутрь которых спускаемся при разборе moov
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'dinf'}
+
+# Атомы с полями creation_time/modification_time
+TIMESTAMP_BOXES = {b'mvhd', b'tkhd', b'mdhd'}
+
+# Расширения, которые умеет разбирать патчер
+SUPPORTED_EXTENSIONS = {'.mp4', '.mov', '.m4v'}
+
+# Основной бренд ftyp файлов QuickTime: там meta не FullBox, метаданные
+# пишутся классическими текстовыми атомами udta
+QUICKTIME_BRAND = b'qt  '
+
+# Текстовые атомы udta QuickTime, которые патчер пишет заново
+QUICKTIME_TEXT_BOXES = {b'\xa9nam', b'\xa9cmt', b'\xa9swr', b'\xa9day', b'\xa9inf'}
+
+
+def clone_file(src: Path, dst: Path) -> str:
+    """
+    Клонирует файл без прохода через userspace: reflink, если ФС умеет,
+    иначе os.copy_file_range, в крайнем случае обычное копирование
+    
+    Returns:
+        Использованный способ: 'reflink', 'copy_file_range' или 'copy'
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return 'copy_file_range'
+            except OSError:
+                pass
+            
+            # Начинаем заново обычным копированием
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        return 'copy'
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    """Собирает атом с 32-битным заголовком"""
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def _read_box_header(data: bytes, offset: int, end: int) -> Tuple[bytes, int, int]:
+    """
+    Читает заголовок атома из буфера
+    
+    Returns:
+        (тип, полный размер, размер заголовка)
+    """
+    size, box_type = struct.unpack_from('>I4s', data, offset)
+    header_size = 8
+    if size == 1:
+        size = struct.unpack_from('>Q', data, offset + 8)[0]
+        header_size = 16
+    elif size == 0:
+        size = end - offset
+    if size < header_size or offset + size > end:
+        raise ValueError(f"Broken box {box_type!r} at offset {offset}")
+    return box_type, size, header_size
+
+
+class Mp4BoxPatcher:
+    """
+    Создает уникальные копии MP4/MOV без FFmpeg: дерево атомов разбирается
+    один раз, каждая копия клонируется и патчится на месте (временные метки
+    mvhd/tkhd/mdhd, метаданные udta/ilst и уникальный атом free)
+    """
+    
+    def __init__(self, input_path: Path):
+        self.input_path = input_path
+        self.file_size = input_path.stat().st_size
+        self.top_level_boxes: List[Tuple[bytes, int, int]] = []
+        self.moov_offset = 0
+        self.moov_size = 0
+        self.moov = b''
+        self.moov_children: List[Tuple[bytes, int, int]] = []
+        self.timestamp_offsets: List[int] = []
+        # Файл QuickTime (бренд qt или нет ftyp), а не ISO MP4
+        self.quicktime = False
+        # Атомы с размером 0 ("до конца файла"): в копии размер
+        # записывается явно, иначе дописанное в конец попало бы внутрь
+        self.open_ended_boxes: List[Tuple[int, int]] = []
+        
+        self._parse()
+    
+    def _parse(self):
+        """
+        Разбирает атомы верхнего уровня и дерево moov
+        """
+        with open(self.input_path, 'rb') as f:
+            offset = 0
+            while offset + 8 <= self.file_size:
+                f.seek(offset)
+                header = f.read(16)
+                box_type, size, _ = _read_box_header(
+                    header.ljust(16, b'\x00'), 0, self.file_size - offset
+                )
+                self.top_level_boxes.append((box_type, offset, size))
+                if header[:4] == b'\x00' * 4 and box_type != b'moov':
+                    if size > 0xFFFFFFFF:
+                        raise ValueError(f"Box {box_type!r} runs to end of file and does not fit a 32-bit size")
+                    self.open_ended_boxes.append((offset, size))
+                offset += size
+            
+            moov = [box for box in self.top_level_boxes if box[0] == b'moov']
+            if not moov:
+                raise ValueError("moov box not found")
+            
+            ftyp = [box for box in self.top_level_boxes if box[0] == b'ftyp']
+            if ftyp:
+                f.seek(ftyp[0][1] + 8)
+                self.quicktime = f.read(4) == QUICKTIME_BRAND
+            else:
+                self.quicktime = True
+            
+            _, self.moov_offset, self.moov_size = moov[0]
+            f.seek(self.moov_offset)
+            self.moov = f.read(self.moov_size)
+        
+        _, _, header_size = _read_box_header(self.moov, 0, self.moov_size)
+        self.moov_children = self._walk(header_size, self.moov_size)
+    
+    def _walk(self, start: int, end: int) -> List[Tuple[bytes, int, int]]:
+        """
+        Обходит атомы в moov, запоминает смещения атомов с временными
+        метками и возвращает прямых потомков диапазона
+        """
+        children = []
+        offset = start
+        while offset + 8 <= end:
+            box_type, size, header_size = _read_box_header(self.moov, offset, end)
+            children.append((box_type, offset, size))
+            
+            if box_type in TIMESTAMP_BOXES:
+                self.timestamp_offsets.append(offset + header_size)
+            elif box_type in CONTAINER_BOXES:
+                self._walk(offset + header_size, offset + size)
+            
+            offset += size
+        return children
+    
+    def create_copy(self, output_path: Path, params: Dict) -> bool:
+        """
+        Создает копию: клонирует вход и патчит moov и хвост файла
+        
+        Args:
+            output_path: путь для сохранения копии
+            params: параметры из VideoUniquifier._generate_unique_params
+        
+        Returns:
+            True если успешно, False при ошибке
+        """
+        try:
+            clone_file(self.input_path, output_path)
+            
+            moov = bytearray(self.moov)
+            self._patch_timestamps(moov, params)
+            new_moov = self._rebuild_moov(moov, params)
+            
+            with open(output_path, 'r+b') as f:
+                for offset, size in self.open_ended_boxes:
+                    f.seek(offset)
+                    f.write(struct.pack('>I', size))
+                
+                if len(new_moov) == self.moov_size:
+                    f.seek(self.moov_offset)
+                    f.write(new_moov)
+                elif self.moov_offset + self.moov_size == self.file_size:
+                    # moov в конце файла - просто переписываем хвост
+                    f.seek(self.moov_offset)
+                    f.write(new_moov)
+                    f.truncate()
+                else:
+                    # moov перед mdat: старый превращаем в free, новый
+                    # дописываем в конец - смещения чанков не меняются
+                    f.seek(self.moov_offset + 4)
+                    f.write(b'free')
+                    f.seek(0, os.SEEK_END)
+                    f.write(new_moov)
+                
+                f.seek(0, os.SEEK_END)
+                f.write(self._build_free_box(params))
+            
+            return output_path.exists()
+        
+        except Exception as e:
+            print(f"Error patching MP4 copy: {str(e)}")
+            return False
+    
+    def _patch_timestamps(self, moov: bytearray, params: Dict):
+        """
+        Меняет creation_time/modification_time в mvhd/tkhd/mdhd на месте
+        """
+        created = datetime.fromisoformat(params['creation_time'])
+        mp4_time = int(created.timestamp()) + MP4_EPOCH_OFFSET
+        
+        for offset in self.timestamp_offsets:
+            version = moov[offset]
+            if version == 1:
+                struct.pack_into('>QQ', moov, offset + 4, mp4_time, mp4_time)
+            else:
+                mp4_time_32 = mp4_time & 0xFFFFFFFF
+                struct.pack_into('>II', moov, offset + 4, mp4_time_32, mp4_time_32)
+    
+    def _rebuild_moov(self, moov: bytearray, params: Dict) -> bytes:
+        """
+        Пересобирает moov с новым udta/meta/ilst (у QuickTime - с новыми
+        текстовыми атомами udta), остальные атомы копируются как есть
+        """
+        payload = b''
+        old_udta_children = []
+        
+        for box_type, offset, size in self.moov_children:
+            if box_type == b'udta':
+                old_udta_children = self._udta_children(moov, offset, size)
+                continue
+            payload += bytes(moov[offset:offset + size])
+        
+        replaced = QUICKTIME_TEXT_BOXES if self.quicktime else {b'meta'}
+        udta_payload = b''.join(
+            bytes(moov[offset:offset + size])
+            for box_type, offset, size in old_udta_children
+            if box_type not in replaced
+        )
+        if self.quicktime:
+            udta_payload += self._build_quicktime_text_boxes(params)
+        else:
+            udta_payload += self._build_meta_box(params)
+        payload += _box(b'udta', udta_payload)
+        
+        return _box(b'moov', payload)
+    
+    def _udta_children(self, moov: bytearray, offset: int, size: int) -> List[Tuple[bytes, int, int]]:
+        """Прямые потомки udta"""
+        _, _, header_size = _read_box_header(moov, offset, offset + size)
+        children = []
+        position = offset + header_size
+        while position + 8 <= offset + size:
+            box_type, child_size, _ = _read_box_header(moov, position, offset + size)
+            children.append((box_type, position, child_size))
+            position += child_size
+        return children
+    
+    def _build_meta_box(self, params: Dict) -> bytes:
+        """
+        Собирает meta/hdlr/ilst в формате iTunes
+        """
+        def text_item(name: bytes, value: str) -> bytes:
+            # data: тип 1 (UTF-8), локаль 0
+            data = _box(b'data', struct.pack('>II', 1, 0) + value.encode('utf-8'))
+            return _box(name, data)
+        
+        def freeform_item(name: str, value: str) -> bytes:
+            mean = _box(b'mean', b'\x00' * 4 + b'com.apple.iTunes')
+            item_name = _box(b'name', b'\x00' * 4 + name.encode('utf-8'))
+            data = _box(b'data', struct.pack('>II', 1, 0) + value.encode('utf-8'))
+            return _box(b'----', mean + item_name + data)
+        
+        ilst = _box(b'ilst', b''.join([
+            text_item(b'\xa9nam', f"Video_{params['copy_number']:03d}"),
+            text_item(b'\xa9cmt', f"Unique_Copy_{params['copy_number']}"),
+            text_item(b'\xa9too', params['encoder_tag']),
+            text_item(b'\xa9day', params['creation_time']),
+            freeform_item('unique_id', params['unique_id']),
+        ]))
+        
+        hdlr = _box(
+            b'hdlr',
+            b'\x00' * 4 + b'\x00' * 4 + b'mdir' + b'appl' + b'\x00' * 8 + b'\x00'
+        )
+        
+        # meta в MP4 - FullBox: version/flags перед потомками
+        return _box(b'meta', b'\x00' * 4 + hdlr + ilst)
+    
+    def _build_quicktime_text_boxes(self, params: Dict) -> bytes:
+        """
+        Классические текстовые атомы udta QuickTime: длина текста,
+        код языка (0 - английский Mac) и сам текст
+        """
+        def text_box(name: bytes, value: str) -> bytes:
+            text = value.encode('utf-8')
+            return _box(name, struct.pack('>HH', len(text), 0) + text)
+        
+        return b''.join([
+            text_box(b'\xa9nam', f"Video_{params['copy_number']:03d}"),
+            text_box(b'\xa9cmt', f"Unique_Copy_{params['copy_number']}"),
+            text_box(b'\xa9swr', params['encoder_tag']),
+            text_box(b'\xa9day', params['creation_time']),
+            text_box(b'\xa9inf', params['unique_id']),
+        ])
+    
+    def _build_free_box(self, params: Dict) -> bytes:
+        """
+        Атом free с уникальным содержимым переменной длины
+        """
+        seed = hashlib.sha256(params['unique_id'].encode()).digest()
+        length = 32 + seed[0]
+        
+        payload = b''
+        block = seed
+        while len(payload) < length:
+            block = hashlib.sha256(block).digest()
+            payload += block
+        
+        return _box(b'free', payload[:length])
@@ -0,0 +1,67 @@
+import shutil
+from contextvars import ContextVar
+from typing import Callable, List, Optional
+
+from app.models import PriorityClass
+
+
+# Уровень nice и аргументы ionice для класса задачи. Повысить приоритет
+# выше обычного без прав root нельзя, поэтому interactive остается на 0
+PRIORITY_LEVELS = {
+    PriorityClass.INTERACTIVE: {'nice': 0, 'ionice': ['-c', '2', '-n', '0']},
+    PriorityClass.STANDARD: {'nice': 5, 'ionice': ['-c', '2', '-n', '4']},
+    PriorityClass.BULK: {'nice': 15, 'ionice': ['-c', '3']},
+}
+
+# nice/ionice есть не везде (Windows, минимальные контейнеры)
+NICE_PATH = shutil.which('nice')
+IONICE_PATH = shutil.which('ionice')
+
+# Класс задачи, чью работу сейчас выполняет поток или корутина.
+# asyncio.to_thread переносит значение в поток вместе с контекстом
+_current: ContextVar[Optional[PriorityClass]] = ContextVar('priority', default=None)
+
+
+def set_task_priority(priority: Optional[PriorityClass]):
+    """
+    Задает класс для текущей задачи asyncio: все ее стадии в
+    asyncio.to_thread запускают FFmpeg с nice/ionice этого класса
+    """
+    _current.set(priority)
+
+
+def run_with_priority(priority: Optional[PriorityClass], func: Callable, *args):
+    """
+    Выполняет func в текущем потоке так, что все запущенные из нее
+    процессы FFmpeg получают nice/ionice класса задачи
+    """
+    token = _current.set(priority)
+    try:
+        return func(*args)
+    finally:
+        _current.reset(token)
+
+
+def priority_prefix(priority: Optional[PriorityClass]) -> List[str]:
+    """
+    Префикс nice/ionice для команды задачи данного класса (ionice -t:
+    без прав на смену приоритета диска команда все равно запускается)
+    """
+    if priority is None:
+        return []
+    
+    levels = PRIORITY_LEVELS[priority]
+    prefix = []
+    if NICE_PATH and levels['nice']:
+        prefix.extend([NICE_PATH, '-n', str(levels['nice'])])
+    if IONICE_PATH:
+        prefix.extend([IONICE_PATH, '-t'] + levels['ionice'])
+    return prefix
+
+
+def with_priority(command: List[str]) -> List[str]:
+    """
+    Оборачивает команду в nice/ionice по классу текущей задачи.
+    Вне задачи с классом команда не меняется
+    """
+    return priority_prefix(_current.get()) + command
@@ -0,0 +1,220 @@
+import contextvars
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.process_priority import with_priority
+from app.services.media_probe import analyze_media, apply_window
+
+
+# Запас на округление pts_time в выводе ffprobe (секунды)
+TIME_EPSILON = 0.0005
+
+
+def plan_segment_count(duration: float) -> int:
+    """
+    Сколько сегментов кодировать параллельно: по числу ядер (x264 плохо
+    масштабируется дальше 8-16 потоков) и не короче минимальной длины сегмента
+    """
+    cores = os.cpu_count() or 1
+    by_cores = cores // max(1, settings.segment_encoder_threads)
+    by_duration = int(duration // max(1, settings.segment_min_duration))
+    return max(1, min(by_cores, by_duration))
+
+
+def choose_segment_bounds(keyframes: List[float], duration: float, count: int) -> List[Tuple[float, float]]:
+    """
+    Делит вход на count сегментов по ключевым кадрам, ближайшим к
+    равномерным точкам разреза
+    
+    Returns:
+        Список сегментов (начало, конец) в секундах
+    """
+    cuts = set()
+    for i in range(1, count):
+        target = duration * i / count
+        nearest = min(keyframes, key=lambda keyframe: abs(keyframe - target))
+        if 0 < nearest < duration:
+            cuts.add(nearest)
+    
+    points = [0.0] + sorted(cuts) + [duration]
+    return [
+        (max(0.0, start - TIME_EPSILON), end - TIME_EPSILON if end < duration else end)
+        for start, end in zip(points, points[1:])
+    ]
+
+
+class ParallelSegmentEncoder:
+    """
+    Параллельное кодирование одной копии: вход режется по ключевым
+    кадрам на K сегментов, сегменты кодируются одновременно с одинаковыми
+    параметрами копии и склеиваются concat-демуксером
+    """
+    
+    def __init__(self, uniquifier, input_path: Path, work_dir: Path, window: Optional[Dict] = None):
+        self.uniquifier = uniquifier
+        self.input_path = input_path
+        self.work_dir = work_dir
+        # Окно задачи: сегменты отсчитываются от его начала
+        self.window = window
+        self.offset = window['start'] if window else 0.0
+        self.has_audio = False
+        self.bounds: List[Tuple[float, float]] = []
+    
+    def prepare(self) -> bool:
+        """
+        Проба входа и выбор границ сегментов (одна на задачу)
+        
+        Returns:
+            False если вход слишком короткий или ядер мало для разбиения
+        """
+        media = apply_window(analyze_media(self.input_path, with_keyframes=True), self.window)
+        duration = media['duration']
+        count = plan_segment_count(duration)
+        if count < 2:
+            return False
+        
+        keyframes = [
+            keyframe - media['start_time']
+            for keyframe in media['keyframes']
+        ]
+        if not keyframes:
+            return False
+        
+        self.bounds = choose_segment_bounds(keyframes, duration, count)
+        if len(self.bounds) < 2:
+            return False
+        
+        self.has_audio = media['has_audio']
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        return True
+    
+    def create_copy(self, output_path: Path, params: Dict) -> bool:
+        """
+        Кодирует сегменты (и аудио) копии параллельно и склеивает их
+        """
+        copy_dir = self.work_dir / f"copy_{params['copy_number']:05d}"
+        copy_dir.mkdir(exist_ok=True)
+        
+        try:
+            segments = [
+                copy_dir / f"segment_{number:05d}.ts"
+                for number in range(len(self.bounds))
+            ]
+            # Готовый вариант аудио из пула задачи, иначе кодируем свой
+            audio_path = params.get('audio_source') or copy_dir / 'audio.m4a'
+            
+            # Потоки executor не наследуют контекст: каждая работа идет в
+            # копии контекста копии, чтобы FFmpeg получил класс приоритета задачи
+            with ThreadPoolExecutor(max_workers=len(segments) + 1) as executor:
+                futures = [
+                    executor.submit(
+                        contextvars.copy_context().run,
+                        self._encode_segment, start, end, segment_path, params
+                    )
+                    for (start, end), segment_path in zip(self.bounds, segments)
+                ]
+                if self.has_audio and not params.get('audio_source'):
+                    futures.append(executor.submit(
+                        contextvars.copy_context().run, self._encode_audio, audio_path, params
+                    ))
+                
+                for future in futures:
+                    future.result()
+            
+            concat_list = copy_dir / 'concat.txt'
+            concat_list.write_text(
+                ''.join(f"file '{segment_path.resolve()}'\n" for segment_path in segments)
+            )
+            
+            command = [
+                'ffmpeg',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', str(concat_list),
+            ]
+            if self.has_audio:
+                command.extend(['-i', str(audio_path)])
+            command.extend([
+                '-y',
+                '-map', '0:v:0',
+            ])
+            if self.has_audio:
+                command.extend(['-map', '1:a:0'])
+            command.extend(['-c', 'copy'])
+            command.extend(self.uniquifier._build_metadata_args(params))
+            command.extend(self.uniquifier._build_container_args(params))
+            command.append(str(output_path))
+            
+            self._run(command)
+            return output_path.exists()
+        
+        except subprocess.CalledProcessError as e:
+            print(f"FFmpeg segment encode error: {e.stderr}")
+            params['ffmpeg_error'] = e.stderr
+            return False
+        except Exception as e:
+            print(f"Error in segmented encode: {str(e)}")
+            return False
+        finally:
+            shutil.rmtree(copy_dir, ignore_errors=True)
+    
+    def _encode_segment(self, start: float, end: float, output_path: Path, params: Dict):
+        """
+        Кодирует сегмент [start, end) с параметрами копии
+        """
+        command = [
+            'ffmpeg',
+            '-ss', f"{self.offset + start:.6f}",
+            '-i', str(self.input_path),
+            '-t', f"{end - start:.6f}",
+            '-y',
+            '-map', '0:v:0',
+        ]
+        
+        video_filters = self.uniquifier._build_video_filters(params)
+        if video_filters:
+            command.extend(['-vf', ','.join(video_filters)])
+        
+        command.extend(self.uniquifier._build_video_codec_args(params))
+        command.extend([
+            '-threads', str(settings.segment_encoder_threads),
+            '-f', 'mpegts',
+            str(output_path),
+        ])
+        
+        self._run(command)
+    
+    def _encode_audio(self, output_path: Path, params: Dict):
+        """
+        Кодирует аудио копии целиком, параллельно с видеосегментами
+        """
+        command = ['ffmpeg']
+        command.extend(self.uniquifier._build_input_args(self.input_path, self.window))
+        command.extend([
+            '-y',
+            '-map', '0:a:0',
+            '-vn',
+        ])
+        command.extend(self.uniquifier._build_audio_codec_args(params))
+        command.extend(['-af', self.uniquifier._build_audio_filter(params)])
+        command.append(str(output_path))
+        
+        self._run(command)
+    
+    def _run(self, command: List[str]):
+        """Запускает FFmpeg, при ошибке бросает CalledProcessError"""
+        subprocess.run(
+            with_priority(command),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    
+    def cleanup(self):
+        """Удаляет рабочую директорию сегментов"""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -0,0 +1,340 @@
+import math
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from app.models import SpeedClass
+from app.services.media_probe import analyze_media, get_stream, probe_clean_keyframes
+from app.services.process_priority import with_priority
+
+
+# Кодеры, которыми можно перекодировать GOP совместимо с исходным потоком
+SMART_ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+}
+
+# Профили ffprobe -> профили кодера: перекодированные GOP не должны
+# требовать от декодера больше, чем исходный поток
+SMART_PROFILES = {
+    'h264': {
+        'Constrained Baseline': 'baseline',
+        'Baseline': 'baseline',
+        'Main': 'main',
+        'High': 'high',
+        'High 10': 'high10',
+        'High 4:2:2': 'high422',
+        'High 4:4:4 Predictive': 'high444',
+    },
+    'hevc': {
+        'Main': 'main',
+        'Main 10': 'main10',
+    },
+}
+
+# Теги дорожки с параметрами (SPS/PPS/VPS) внутри потока: у перекодированных
+# GOP они свои, а один avc1/hvc1 sample entry описал бы только исходные
+IN_BAND_TAGS = {
+    'h264': 'avc3',
+    'hevc': 'hev1',
+}
+
+# Контейнеры, в которых тег дорожки выбирается явно
+TAGGED_EXTENSIONS = {'.mp4', '.mov'}
+
+# Запас на округление pts_time в выводе ffprobe (секунды)
+TIME_EPSILON = 0.0005
+
+
+class SmartRenderer:
+    """
+    Smart rendering: в каждой копии перекодируются только первые GOP
+    (и, возможно, один GOP из середины), остальные пакеты копируются.
+    Ключевые кадры берутся из одной пакетной пробы на задачу, а копируемые
+    куски нарезаются один раз и переиспользуются всеми копиями
+    """
+    
+    def __init__(
+        self,
+        uniquifier,
+        input_path: Path,
+        work_dir: Path,
+        total_copies: int,
+        speed_class: SpeedClass = SpeedClass.BALANCED
+    ):
+        self.uniquifier = uniquifier
+        self.input_path = input_path
+        self.work_dir = work_dir
+        self.total_copies = total_copies
+        self.speed_class = speed_class
+        self.video_stream: Dict = {}
+        # Времена чистых точек разреза (IDR/closed GOP) относительно начала
+        # файла; первая - начало файла, с него перекодируется голова
+        self.keyframes: List[float] = []
+        # Номер копии -> перекодируемые диапазоны GOP [a, b) по индексам ключевых кадров
+        self.plans: Dict[int, List[Tuple[int, int]]] = {}
+        # Границы нарезанных кусков (индексы ключевых кадров) и сами куски
+        self.bounds: List[int] = []
+        self.pieces: Dict[int, Path] = {}
+    
+    def prepare(self) -> bool:
+        """
+        Проба входа, план перекодирования для всех копий и однократная
+        нарезка копируемых кусков
+        
+        Returns:
+            False если вход не подходит для smart rendering
+        """
+        media = analyze_media(self.input_path)
+        self.video_stream = get_stream(media, 'video') or {}
+        codec = self.video_stream.get('codec_name')
+        if codec not in SMART_ENCODERS:
+            return False
+        
+        # Копируемый кусок может начинаться только с кадра, которому не нужны
+        # кадры перед ним: open GOP и непроверенные ключевые кадры не годятся
+        cuts = [
+            keyframe - media['start_time']
+            for keyframe in probe_clean_keyframes(self.input_path, codec)
+        ]
+        self.keyframes = [0.0] + [cut for cut in cuts if cut > TIME_EPSILON]
+        if len(self.keyframes) < 2:
+            return False
+        
+        for copy_number in range(1, self.total_copies + 1):
+            params = self.uniquifier._generate_unique_params(
+                copy_number, self.total_copies, media, self.speed_class
+            )
+            self.plans[copy_number] = self._plan_copy(params)
+        
+        cuts = {index for ranges in self.plans.values() for range_ in ranges for index in range_}
+        self.bounds = sorted(cuts | {0, len(self.keyframes)})
+        
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        return self._split_pieces()
+    
+    def _plan_copy(self, params: Dict) -> List[Tuple[int, int]]:
+        """
+        Выбирает перекодируемые GOP копии: первые 1-2 GOP и, если
+        ключевых кадров достаточно, один GOP из середины
+        """
+        count = len(self.keyframes)
+        head = min(params['smart_head_gops'], count - 1)
+        ranges = [(0, head)]
+        
+        # Между головой и средним GOP, а также после него должен остаться
+        # хотя бы один копируемый GOP
+        if params['smart_interior'] and count - head >= 3:
+            interior = head + 1 + int(params['smart_interior_position'] * (count - head - 2))
+            interior = min(interior, count - 2)
+            ranges.append((interior, interior + 1))
+        
+        return ranges
+    
+    def _split_pieces(self) -> bool:
+        """
+        Нарезает видеопоток по всем границам планов одним проходом -c copy
+        """
+        split_times = [
+            f"{self.keyframes[index] - TIME_EPSILON:.6f}"
+            for index in self.bounds[1:-1]
+        ]
+        
+        command = [
+            'ffmpeg',
+            '-i', str(self.input_path),
+            '-y',
+            '-map', '0:v:0',
+            '-c', 'copy',
+            '-f', 'segment',
+            '-segment_format', 'mpegts',
+            '-reset_timestamps', '1',
+        ]
+        if split_times:
+            command.extend(['-segment_times', ','.join(split_times)])
+        command.append(str(self.work_dir / 'piece_%05d.ts'))
+        
+        self._run(command)
+        
+        for number, start in enumerate(self.bounds[:-1]):
+            piece = self.work_dir / f"piece_{number:05d}.ts"
+            if not piece.exists():
+                print(f"Smart render: missing piece {piece.name}")
+                return False
+            self.pieces[start] = piece
+        
+        return True
+    
+    def create_copy(self, output_path: Path, params: Dict) -> bool:
+        """
+        Собирает копию: перекодированные GOP + скопированные куски + исходное аудио
+        """
+        copy_dir = self.work_dir / f"copy_{params['copy_number']:05d}"
+        copy_dir.mkdir(exist_ok=True)
+        
+        try:
+            encoded = {}
+            for start, end in self.plans[params['copy_number']]:
+                segment_path = copy_dir / f"encoded_{start:05d}.ts"
+                self._encode_range(start, end, segment_path, params)
+                encoded[start] = (end, segment_path)
+            
+            concat_list = copy_dir / 'concat.txt'
+            lines = []
+            position = 0
+            for start in self.bounds[:-1]:
+                if start < position:
+                    continue  # кусок внутри перекодированного диапазона
+                if start in encoded:
+                    position, segment_path = encoded[start]
+                    lines.append(f"file '{segment_path.resolve()}'")
+                else:
+                    lines.append(f"file '{self.pieces[start].resolve()}'")
+            concat_list.write_text('\n'.join(lines) + '\n')
+            
+            command = [
+                'ffmpeg',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', str(concat_list),
+                # Аудио из пула задачи или исходное
+                '-i', str(params.get('audio_source') or self.input_path),
+                '-y',
+                '-map', '0:v:0',
+                '-map', '1:a?',
+                '-c', 'copy',
+            ]
+            if output_path.suffix.lower() in TAGGED_EXTENSIONS:
+                command.extend(['-tag:v', IN_BAND_TAGS[self.video_stream['codec_name']]])
+            command.extend(self.uniquifier._build_metadata_args(params))
+            command.extend(self.uniquifier._build_container_args(params))
+            command.append(str(output_path))
+            
+            self._run(command)
+            return output_path.exists()
+        
+        except subprocess.CalledProcessError as e:
+            print(f"FFmpeg smart render error: {e.stderr}")
+            params['ffmpeg_error'] = e.stderr
+            return False
+        except Exception as e:
+            print(f"Error in smart render: {str(e)}")
+            return False
+        finally:
+            shutil.rmtree(copy_dir, ignore_errors=True)
+    
+    def _encode_range(self, start: int, end: int, output_path: Path, params: Dict):
+        """
+        Перекодирует GOP [start, end) с вариацией геометрии и CRF,
+        сохраняя размер кадра, pix_fmt и тайминг исходного потока
+        """
+        seek = max(0.0, self.keyframes[start] - TIME_EPSILON)
+        duration = self.keyframes[end] - self.keyframes[start]
+        
+        command = [
+            'ffmpeg',
+            '-ss', f"{seek:.6f}",
+            '-i', str(self.input_path),
+            '-t', f"{duration:.6f}",
+            '-y',
+            '-map', '0:v:0',
+            '-vf', self._build_same_size_filter(params),
+        ]
+        command.extend(self._build_encoder_args(params))
+        command.extend([
+            '-fps_mode', 'passthrough',
+            '-f', 'mpegts',
+            str(output_path),
+        ])
+        
+        self._run(command)
+    
+    def _build_same_size_filter(self, params: Dict) -> str:
+        """
+        Микро-увеличение и обрезка обратно до исходного размера
+        со сдвигом - размер кадра не меняется
+        """
+        width = int(self.video_stream['width'])
+        height = int(self.video_stream['height'])
+        factor = 1 + abs(params['scale_factor'] - 1.0)
+        
+        scaled_width = math.ceil(width * factor / 2) * 2
+        scaled_height = math.ceil(height * factor / 2) * 2
+        x = round((params['shift_x'] + 0.5) * (scaled_width - width))
+        y = round((params['shift_y'] + 0.5) * (scaled_height - height))
+        
+        return (
+            f"scale={scaled_width}:{scaled_height}:flags=bicubic,"
+            f"crop={width}:{height}:{x}:{y}"
+        )
+    
+    def _build_encoder_args(self, params: Dict) -> List[str]:
+        """
+        Параметры кодера того же кодека, что и исходный поток
+        """
+        codec = self.video_stream['codec_name']
+        pixel_format = self.video_stream.get('pix_fmt', 'yuv420p')
+        
+        args = [
+            '-c:v', SMART_ENCODERS[codec],
+            '-preset', params['preset'],
+            '-crf', str(params['crf']),
+            '-pix_fmt', pixel_format,
+        ]
+        
+        if params.get('max_bitrate_kbps'):
+            args.extend([
+                '-maxrate', f"{params['max_bitrate_kbps']}k",
+                '-bufsize', f"{params['max_bitrate_kbps'] * 2}k",
+            ])
+        
+        profile = SMART_PROFILES[codec].get(self.video_stream.get('profile'))
+        if profile:
+            args.extend(['-profile:v', profile])
+        level = self._source_level()
+        
+        if codec == 'hevc':
+            x265_params = f"bframes={params['b_frames']}:ref={params['ref_frames']}:repeat-headers=1"
+            if level:
+                x265_params += f":level-idc={level}"
+            args.extend(['-x265-params', x265_params])
+        else:
+            args.extend([
+                '-bf', str(params['b_frames']),
+                '-refs', str(params['ref_frames']),
+                '-x264-params', 'repeat-headers=1',
+            ])
+            if level:
+                args.extend(['-level', level])
+        
+        return args
+    
+    def _source_level(self) -> str:
+        """
+        Уровень исходного потока в записи кодера ('4.1'), пусто если
+        неизвестен. ffprobe дает level_idc: 41 для H.264, 123 (30 * 4.1) для HEVC
+        """
+        try:
+            level = int(self.video_stream.get('level') or 0)
+        except (TypeError, ValueError):
+            return ''
+        if level <= 0 or self.video_stream['codec_name'] == 'h264' and level < 10:
+            return ''  # неизвестен или level 1b
+        
+        value = level / (30 if self.video_stream['codec_name'] == 'hevc' else 10)
+        return f"{value:g}" if value == int(value) else f"{value:.1f}"
+    
+    
+    def _run(self, command: List[str]):
+        """Запускает FFmpeg, при ошибке бросает CalledProcessError"""
+        subprocess.run(
+            with_priority(command),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    
+    def cleanup(self):
+        """Удаляет нарезанные куски"""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -1,10 +1,159 @@
+import shutil
 import subprocess
 import random
 import hashlib
+import math
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 
+from app.config import settings
+from app.models import ProcessingTier, SpeedClass, OutputProfile
+from app.services.media_probe import analyze_media
+from app.services.process_priority import with_priority
+
+
+# Bitstream-фильтры для кодеков, поддерживающих правку SEI/VUI без перекодирования
+BITSTREAM_FILTERS = {
+    'h264': 'h264_metadata',
+    'hevc': 'hevc_metadata',
+}
+
+# Фильтры геометрии по возрастанию качества: (фильтр, флаги scale,
+# относительная стоимость на мегапиксель). crop только сдвигает указатели
+# плоскостей и почти бесплатен, scale пересчитывает каждый пиксель.
+# fast_bilinear сюда не входит: заметно мылит кадр ради сдвига на ±0.5%,
+# и если качественный scale не укладывается в бюджет, лучше crop
+GEOMETRY_FILTER_COSTS = [
+    ('crop', None, 0.0),
+    ('scale', 'bicubic', 2.5),
+    ('scale', 'lanczos', 4.0),
+]
+
+# Флаги уменьшения по профилю, когда бюджет позволяет только crop:
+# уменьшение обязательно, поэтому берется самый дешевый scale
+DOWNSCALE_FALLBACK_FLAGS = 'fast_bilinear'
+
+# Пресет общего первого и всех вторых проходов по классам скорости
+TWO_PASS_PRESETS = {
+    SpeedClass.FAST: 'faster',
+    SpeedClass.BALANCED: 'medium',
+    SpeedClass.QUALITY: 'slow',
+}
+
+# Поля кадра (пикселей по каждой оси), внутри которых сдвигается окно
+# crop в двухпроходном режиме - размер кадра у всех копий одинаковый
+TWO_PASS_CROP = 8
+
+# Резерв под аудио при пересчете лимита размера в битрейт видео (кбит/с)
+AUDIO_BITRATE_RESERVE_KBPS = 320
+
+# Минимальный битрейт видео, до которого опускается лимит (кбит/с)
+MIN_VIDEO_BITRATE_KBPS = 100
+
+# Контейнеры, для которых выбирается раскладка moov
+LAYOUT_EXTENSIONS = {'.mp4', '.mov'}
+
+# Ошибка muxer'а, когда moov не поместился в зарезервированное место
+MOOV_SPACE_ERROR = 'moov_size'
+
+# Фрагментированный MP4: moov без сэмплов в начале, данные во фрагментах
+FRAGMENTED_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+# Потоковая выдача: фрагменты по длительности, а не по ключевым кадрам -
+# первый фрагмент уходит клиенту через секунду кадров, а не через GOP
+STREAM_MOVFLAGS = '+empty_moov+default_base_moof'
+STREAM_FRAGMENT_US = 1000000
+
+# Короткий lookahead x264 для потока: кодер меньше держит кадры перед выдачей
+STREAM_RC_LOOKAHEAD = 10
+
+# Типичные timescale видеодорожек - кандидаты на вариацию временной базы
+TRACK_TIMESCALES = [
+    12800, 15360, 24000, 25600, 30000, 48000,
+    50000, 60000, 90000, 100000, 120000, 180000,
+]
+
+# Относительная стоимость кодирования пресетов x264 (medium = 1.0)
+PRESET_COSTS = {
+    'veryfast': 0.45,
+    'faster': 0.6,
+    'fast': 0.8,
+    'medium': 1.0,
+    'slow': 1.6,
+    'slower': 2.6,
+}
+
+# Допустимый диапазон относительной стоимости копии для класса скорости
+SPEED_CLASS_COST_RANGES = {
+    SpeedClass.FAST: (0.4, 0.85),
+    SpeedClass.BALANCED: (0.75, 1.2),
+    SpeedClass.QUALITY: (1.3, 2.8),
+}
+
+
+# Профили выхода: короткая сторона кадра, класс скорости и диапазон CRF.
+# Платформы все равно перекодируют в 1080p/720p - кодировать 4K незачем
+OUTPUT_PROFILES = {
+    OutputProfile.SOCIAL_1080P: {
+        'short_side': 1080,
+        'speed_class': SpeedClass.BALANCED,
+        'crf_range': (20, 23),
+    },
+    OutputProfile.FAST_720P: {
+        'short_side': 720,
+        'speed_class': SpeedClass.FAST,
+        'crf_range': (21, 25),
+    },
+}
+
+
+def encode_cost(preset: str, b_frames: int, ref_frames: int) -> float:
+    """
+    Относительная стоимость кодирования кадра: пресет плюс
+    около 5% на каждый опорный кадр и 3% на B-кадр сверх минимума
+    """
+    return PRESET_COSTS[preset] * (1 + 0.05 * (ref_frames - 3) + 0.03 * (b_frames - 2))
+
+
+def varies_time_base(output_format: str) -> bool:
+    """
+    Можно ли менять временную базу видео: только MP4/MOV хранят ее как
+    timescale дорожки. AVI выводит из нее частоту кадров и заполняет
+    промежутки пустыми пакетами, поэтому там остается база источника
+    """
+    return f".{output_format}".lower() in LAYOUT_EXTENSIONS
+
+
+def coprime_multiplier(modulus: int) -> int:
+    """Множитель, взаимно простой с modulus, около золотого сечения"""
+    multiplier = max(1, int(modulus * 0.618))
+    while math.gcd(multiplier, modulus) != 1:
+        multiplier += 1
+    return multiplier
+
+
+@lru_cache(maxsize=None)
+def parameter_space(
+    speed_class: SpeedClass,
+    crf_range: Tuple[int, int] = (17, 23)
+) -> List[Tuple[str, int, int, int, int]]:
+    """
+    Все комбинации (preset, b_frames, ref_frames, crf, gop_size),
+    стоимость которых попадает в диапазон класса скорости
+    """
+    low, high = SPEED_CLASS_COST_RANGES[speed_class]
+    return [
+        (preset, b_frames, ref_frames, crf, gop_size)
+        for preset in PRESET_COSTS
+        for b_frames in range(2, 5)
+        for ref_frames in range(3, 6)
+        if low <= encode_cost(preset, b_frames, ref_frames) <= high
+        for crf in range(crf_range[0], crf_range[1] + 1)
+        for gop_size in range(240, 261)
+    ]
+
 
 class VideoUniquifier:
     """
@@ -26,7 +175,8 @@ class VideoUniquifier:
         input_path: Path, 
         output_path: Path, 
         copy_number: int,
-        total_copies: int
+        total_copies: int,
+        options: Optional[Dict] = None
     ) -> bool:
         """
         Создает одну уникальную копию видео
@@ -36,65 +186,522 @@ class VideoUniquifier:
             output_path: путь для сохранения копии
             copy_number: номер текущей копии
             total_copies: общее количество копий
-            
+            options: параметры задачи (tier и т.д.)
+        
         Returns:
             True если успешно, False при ошибке
         """
+        options = options or {}
+        
         try:
-            params = self._generate_unique_params(copy_number, total_copies)
-            command = self._build_ffmpeg_command(input_path, output_path, params)
+            params = self._prepare_copy_params(copy_number, total_copies, options)
+            return self.create_copy_from_params(input_path, output_path, params, options)
+        
+        except Exception as e:
+            print(f"Error creating unique copy: {str(e)}")
+            return False
+    
+    def create_copy_from_params(
+        self,
+        input_path: Path,
+        output_path: Path,
+        params: Dict,
+        options: Dict
+    ) -> bool:
+        """
+        Создает копию по заранее вычисленным параметрам (например,
+        сохраненным в params.json задачи с отложенной сборкой)
+        """
+        params = dict(params)
+        params['output_layout'] = self._resolve_output_layout(output_path, options, params)
+        
+        if self._write_copy(input_path, output_path, params, options):
+            return True
+        # Остальные ошибки повтор с faststart не исправит
+        if params['output_layout'] != 'reserved' or MOOV_SPACE_ERROR not in (params.get('ffmpeg_error') or ''):
+            return False
+        
+        # Зарезервированного места под moov не хватило - переписываем
+        # копию с faststart на scratch-диске
+        print("Reserved moov space was not enough, retrying with faststart")
+        params['output_layout'] = 'faststart'
+        return self._write_copy(input_path, output_path, params, options)
+    
+    def build_stream_command(
+        self,
+        input_path: Path,
+        copy_number: int,
+        total_copies: int,
+        options: Dict
+    ) -> List[str]:
+        """
+        Команда полного перекодирования копии во фрагментированный MP4
+        в stdout: первые фрагменты готовы через секунды, на диск ничего
+        не пишется. Параметры те же, что у копии с этим номером в задаче
+        """
+        options = dict(options, tier=ProcessingTier.FULL, output_format='mp4')
+        params = self._prepare_copy_params(copy_number, total_copies, options)
+        params['output_layout'] = 'stream'
+        params['rc_lookahead'] = STREAM_RC_LOOKAHEAD
+        
+        command = self._build_ffmpeg_command(input_path, Path('pipe:1'), params, options)
+        # В pipe формат не угадывается по расширению
+        command[-1:-1] = ['-f', 'mp4']
+        return command
+    
+    def _prepare_copy_params(self, copy_number: int, total_copies: int, options: Dict) -> Dict:
+        """
+        Параметры копии после стратегий уникализации, выбора аудио из пула
+        и настроек битрейта задачи
+        """
+        params = self._generate_copy_params(copy_number, total_copies, options)
+        
+        if options.get('tier') == ProcessingTier.BITSTREAM:
+            params['source_codec'] = options.get('video_codec')
+        params = self._apply_strategies(params)
+        self._assign_audio_source(params, options)
+        self._apply_rate_control(params, options)
+        return params
+    
+    def _write_copy(
+        self,
+        input_path: Path,
+        output_path: Path,
+        params: Dict,
+        options: Dict
+    ) -> bool:
+        """
+        Записывает копию способом, выбранным для задачи
+        """
+        target = self._layout_target(output_path, params)
+        
+        try:
+            # Патч атомов MP4 без FFmpeg (дерево разобрано один раз на задачу)
+            if options.get('tier') == ProcessingTier.METADATA and options.get('box_patcher'):
+                success = options['box_patcher'].create_copy(target, params)
             
-            result = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                check=True
-            )
+            # Smart rendering (ключевые кадры и куски общие на задачу)
+            elif options.get('tier') == ProcessingTier.SMART and options.get('smart_renderer'):
+                success = options['smart_renderer'].create_copy(target, params)
+            
+            # Комбинаторная сборка из заранее закодированных вариантов сегментов
+            elif options.get('tier') == ProcessingTier.COMBINATORIAL and options.get('variant_assembler'):
+                success = options['variant_assembler'].create_copy(target, params)
+            
+            # Длинный вход: сегменты одной копии кодируются параллельно
+            elif options.get('segment_encoder'):
+                success = options['segment_encoder'].create_copy(target, params)
             
-            return output_path.exists()
+            else:
+                command = self._build_ffmpeg_command(input_path, target, params, options)
+                subprocess.run(
+                    with_priority(command),
+                    capture_output=True,
+                    text=True,
+                    check=True
+                )
+                success = target.exists()
             
+            return success and self._finish_layout(target, output_path)
+        
         except subprocess.CalledProcessError as e:
             print(f"FFmpeg error: {e.stderr}")
+            params['ffmpeg_error'] = e.stderr
             return False
+        finally:
+            if target != output_path:
+                target.unlink(missing_ok=True)
+    
+    def _resolve_output_layout(self, output_path: Path, options: Dict, params: Dict) -> Optional[str]:
+        """
+        Раскладка moov для копии: только для MP4/MOV и только там, где
+        FFmpeg сам пишет контейнер (патч атомов ее не использует). У ремукса
+        раскладка своя у каждой копии и тоже служит вариацией
+        """
+        if output_path.suffix.lower() not in LAYOUT_EXTENSIONS:
+            return None
+        if options.get('tier') == ProcessingTier.METADATA:
+            return None
+        if options.get('tier') == ProcessingTier.CONTAINER:
+            return params['container_layout']
+        return settings.output_layout
+    
+    def _layout_target(self, output_path: Path, params: Dict) -> Path:
+        """
+        Куда писать копию: faststart перечитывает и переписывает файл
+        целиком, поэтому копия пишется на scratch-диск и потом переносится
+        """
+        if params.get('output_layout') != 'faststart':
+            return output_path
+        return settings.scratch_dir / f"{params['unique_id'][:16]}_{output_path.name}"
+    
+    def _finish_layout(self, target: Path, output_path: Path) -> bool:
+        """Переносит копию со scratch-диска на место"""
+        if target != output_path:
+            shutil.move(str(target), str(output_path))
+        return output_path.exists()
+    
+    def create_unique_batch(
+        self,
+        input_path: Path,
+        outputs: List[Tuple[int, Path]],
+        total_copies: int,
+        options: Optional[Dict] = None
+    ) -> Dict[int, bool]:
+        """
+        Создает несколько уникальных копий одним процессом FFmpeg:
+        вход декодируется один раз и раздается через split/asplit
+        
+        Args:
+            input_path: путь к исходному файлу
+            outputs: список пар (номер копии, путь для сохранения)
+            total_copies: общее количество копий
+            options: параметры задачи (пул аудио и т.д.)
+        
+        Returns:
+            Словарь {номер копии: True/False}
+        """
+        options = options or {}
+        
+        try:
+            options = dict(options, media=options.get('media') or analyze_media(input_path))
+            has_audio = options['media']['has_audio']
+            params_list = [
+                self._generate_copy_params(copy_number, total_copies, options)
+                for copy_number, _ in outputs
+            ]
+            for params, (_, output_path) in zip(params_list, outputs):
+                self._assign_audio_source(params, options)
+                self._apply_rate_control(params, options)
+                params['output_layout'] = self._resolve_output_layout(output_path, options, params)
+            targets = [
+                self._layout_target(output_path, params)
+                for params, (_, output_path) in zip(params_list, outputs)
+            ]
+            command = self._build_batch_ffmpeg_command(
+                input_path,
+                targets,
+                params_list,
+                has_audio
+            )
+            
+            try:
+                subprocess.run(
+                    with_priority(command),
+                    capture_output=True,
+                    text=True,
+                    check=True
+                )
+                
+                return {
+                    copy_number: target.exists() and self._finish_layout(target, output_path)
+                    for target, (copy_number, output_path) in zip(targets, outputs)
+                }
+            finally:
+                for target, (_, output_path) in zip(targets, outputs):
+                    if target != output_path:
+                        target.unlink(missing_ok=True)
+        
+        except subprocess.CalledProcessError as e:
+            print(f"FFmpeg batch error: {e.stderr}")
         except Exception as e:
-            print(f"Error creating unique copy: {str(e)}")
-            return False
+            print(f"Error creating unique batch: {str(e)}")
+        
+        # Если общий процесс упал - создаем копии по одной
+        print("Falling back to per-copy processing")
+        return {
+            copy_number: self.create_unique_copy(
+                input_path, output_path, copy_number, total_copies, options
+            )
+            for copy_number, output_path in outputs
+        }
+    
+    def create_audio_pool(
+        self,
+        input_path: Path,
+        work_dir: Path,
+        pool_size: int,
+        window: Optional[Dict] = None
+    ) -> List[Path]:
+        """
+        Кодирует небольшой пул вариантов аудио один раз на задачу
+        (один процесс FFmpeg, asplit), копии потом берут готовую дорожку
+        без перекодирования
+        
+        Returns:
+            Пути к вариантам аудио, пустой список при ошибке
+        """
+        work_dir.mkdir(parents=True, exist_ok=True)
+        params_list = [
+            self._generate_unique_params(variant, pool_size)
+            for variant in range(1, pool_size + 1)
+        ]
+        output_paths = [
+            work_dir / f"audio_{variant:02d}.m4a"
+            for variant in range(1, pool_size + 1)
+        ]
+        
+        split_labels = ''.join(f"[asplit{i}]" for i in range(pool_size))
+        graph = [f"[0:a:0]asplit={pool_size}{split_labels}"]
+        for i, params in enumerate(params_list):
+            graph.append(f"[asplit{i}]{self._build_audio_filter(params)}[aout{i}]")
+        
+        command = ['ffmpeg']
+        command.extend(self._build_input_args(input_path, window))
+        command.extend([
+            '-y',
+            '-filter_complex', ';'.join(graph),
+        ])
+        for i, (output_path, params) in enumerate(zip(output_paths, params_list)):
+            command.extend(['-map', f"[aout{i}]"])
+            command.extend(self._build_audio_codec_args(params))
+            command.append(str(output_path))
+        
+        try:
+            subprocess.run(
+                with_priority(command),
+                capture_output=True,
+                text=True,
+                check=True
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"FFmpeg audio pool error: {e.stderr}")
+            return []
+        
+        return [output_path for output_path in output_paths if output_path.exists()]
+    
+    def plan_two_pass(
+        self,
+        media: Dict,
+        speed_class: SpeedClass,
+        target_bitrate_kbps: Optional[int] = None,
+        profile: OutputProfile = OutputProfile.SOURCE,
+        output_format: str = 'mp4'
+    ) -> Dict:
+        """
+        Общие для всех копий настройки двухпроходного режима. Статистика
+        x264 годится для второго прохода только при том же размере кадра,
+        числе кадров, B-кадрах, GOP и временной базе - они фиксируются на задачу
+        """
+        profile_settings = OUTPUT_PROFILES.get(profile)
+        if profile_settings:
+            speed_class = profile_settings['speed_class']
+        downscale = self._plan_downscale(media, profile_settings)
+        frame = downscale or media
+        
+        if not target_bitrate_kbps:
+            if not media.get('bit_rate'):
+                raise ValueError("Unknown input bitrate, target bitrate is required")
+            # Битрейт входа, пропорционально уменьшенный вместе с кадром
+            pixel_ratio = frame['width'] * frame['height'] / (media['width'] * media['height'])
+            target_bitrate_kbps = int(int(media['bit_rate']) * pixel_ratio) // 1000
+        
+        return {
+            'preset': TWO_PASS_PRESETS[speed_class],
+            'b_frames': 3,
+            'gop_size': 250,
+            'video_bitrate_kbps': target_bitrate_kbps,
+            # Иначе x264 отклонит второй проход: timebase mismatch with 1st pass
+            'track_timescale': (
+                self._timescale_candidates(media)[0] if varies_time_base(output_format) else None
+            ),
+            'downscale': downscale,
+            'geometry': {
+                'filter': 'crop',
+                'flags': None,
+                'width': frame['width'] - TWO_PASS_CROP,
+                'height': frame['height'] - TWO_PASS_CROP,
+                'x': TWO_PASS_CROP // 2,
+                'y': TWO_PASS_CROP // 2,
+            },
+        }
+    
+    def create_first_pass(
+        self,
+        input_path: Path,
+        work_dir: Path,
+        two_pass: Dict,
+        window: Optional[Dict] = None
+    ) -> Dict:
+        """
+        Первый проход x264 один раз на задачу с нейтральными настройками;
+        копии потом делают только второй проход по общей статистике
+        
+        Returns:
+            two_pass с путем к статистике (passlogfile)
+        """
+        work_dir.mkdir(parents=True, exist_ok=True)
+        two_pass = dict(two_pass, passlogfile=work_dir / 'x264')
+        params = dict(self._generate_unique_params(1, 1), **two_pass, video_pass=1)
+        
+        command = ['ffmpeg']
+        command.extend(self._build_input_args(input_path, window))
+        command.extend([
+            '-y',
+            '-map', '0:v:0',
+            '-vf', ','.join(self._build_video_filters(params)),
+        ])
+        command.extend(self._build_video_codec_args(params))
+        command.extend(['-an', '-f', 'null', '-'])
+        
+        subprocess.run(
+            with_priority(command),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return two_pass
+    
+    def plan_size_cap(
+        self,
+        media: Dict,
+        input_size: int,
+        max_bitrate_kbps: Optional[int] = None,
+        max_size_percent: Optional[float] = None
+    ) -> Optional[Dict]:
+        """
+        Лимит размера копии: максимальный битрейт или процент от размера
+        входа переводится в максимальный битрейт видео для VBV
+        (за вычетом резерва под аудио) и целевой размер файла
+        
+        Returns:
+            {'max_bitrate_kbps', 'target_bytes'} или None без лимита
+        """
+        duration = media.get('duration') or 0
+        if duration <= 0:
+            return None
+        
+        caps = []
+        if max_bitrate_kbps:
+            caps.append(max_bitrate_kbps)
+        if max_size_percent:
+            caps.append(int(input_size * max_size_percent / 100 * 8 / duration / 1000))
+        if not caps:
+            return None
+        
+        total_kbps = min(caps)
+        
+        audio_kbps = AUDIO_BITRATE_RESERVE_KBPS if media.get('has_audio') else 0
+        return {
+            'max_bitrate_kbps': max(MIN_VIDEO_BITRATE_KBPS, total_kbps - audio_kbps),
+            'target_bytes': int(total_kbps * 1000 / 8 * duration),
+        }
     
-    def _generate_unique_params(self, copy_number: int, total_copies: int) -> Dict:
+    def _apply_rate_control(self, params: Dict, options: Dict):
+        """
+        Лимит битрейта задачи (VBV) и второй проход по общей статистике:
+        свои у копии только сдвиг окна crop, опорные кадры и битрейт
+        в пределах ±2%
+        """
+        size_cap = options.get('size_cap')
+        if size_cap:
+            params['max_bitrate_kbps'] = size_cap['max_bitrate_kbps']
+        
+        two_pass = options.get('two_pass')
+        if not two_pass:
+            return
+        
+        variation = int(params['unique_id'][:4], 16) / 0xFFFF
+        params.update(two_pass)
+        params['video_pass'] = 2
+        params['video_bitrate_kbps'] = round(two_pass['video_bitrate_kbps'] * (0.98 + 0.04 * variation))
+        if size_cap:
+            params['video_bitrate_kbps'] = min(params['video_bitrate_kbps'], size_cap['max_bitrate_kbps'])
+        # Четные сдвиги - без пересчета цветности 4:2:0
+        params['geometry'] = dict(
+            two_pass['geometry'],
+            x=round((params['shift_x'] + 0.5) * TWO_PASS_CROP / 2) * 2,
+            y=round((params['shift_y'] + 0.5) * TWO_PASS_CROP / 2) * 2,
+        )
+    
+    def _assign_audio_source(self, params: Dict, options: Dict):
+        """
+        Закрепляет за копией готовый вариант аудио из пула задачи
+        """
+        audio_pool = options.get('audio_pool')
+        if audio_pool:
+            params['audio_source'] = audio_pool[(params['copy_number'] - 1) % len(audio_pool)]
+    
+    def _generate_copy_params(self, copy_number: int, total_copies: int, options: Dict) -> Dict:
+        """
+        Параметры копии с учетом анализа входа, класса скорости, профиля
+        и окна (фрагмента входа) задачи
+        """
+        params = self._generate_unique_params(
+            copy_number,
+            total_copies,
+            options.get('media'),
+            options.get('speed_class', SpeedClass.BALANCED),
+            options.get('profile', OutputProfile.SOURCE),
+            options.get('base_time')
+        )
+        params['window'] = options.get('window')
+        if not varies_time_base(options.get('output_format', 'mp4')):
+            params['track_timescale'] = None
+        return params
+    
+    def _generate_unique_params(
+        self,
+        copy_number: int,
+        total_copies: int,
+        media: Optional[Dict] = None,
+        speed_class: SpeedClass = SpeedClass.BALANCED,
+        profile: OutputProfile = OutputProfile.SOURCE,
+        base_time: Optional[float] = None
+    ) -> Dict:
         """
         Генерирует уникальные параметры для каждой копии
+        
+        Профиль выхода задает уменьшение кадра (первым фильтром), класс
+        скорости и диапазон CRF вместо переданных
+        
+        Параметры кодирования берутся только из комбинаций, чья стоимость
+        укладывается в класс скорости. Номер копии переводится в комбинацию
+        биекцией (a*i mod M), поэтому до M копий попарно различаются
+        набором (preset, b_frames, ref_frames, crf, gop_size)
+        
+        Если передан анализ входа (analyze_media), параметры не добавляют
+        лишней работы: число кадров как у источника (меняется только
+        временная база), аудио параметры только при наличии аудио
+        
+        При одинаковом base_time (время создания задачи) результат полностью
+        воспроизводим: случайные величины берутся из генератора копии,
+        а не из глобального random
         """
-        # Используем номер копии как seed для воспроизводимости
-        random.seed(copy_number)
+        media = media or {}
         
-        # Параметры FPS (микросдвиги)
-        fps_variations = [23.976, 24, 25, 29.97, 30, 30.01, 50, 59.94, 60]
-        fps_base = random.choice(fps_variations)
-        fps_offset = random.uniform(-0.001, 0.001)
+        # Собственный генератор копии: воспроизводимо и без гонок между потоками
+        rng = random.Random(copy_number)
         
-        # Параметры видео
-        crf_variation = random.randint(17, 23)  # Высокое качество
-        preset_options = ['slower', 'slow', 'medium']
-        preset = random.choice(preset_options)
+        profile_settings = OUTPUT_PROFILES.get(profile)
+        crf_range = (17, 23)  # Высокое качество
+        if profile_settings:
+            speed_class = profile_settings['speed_class']
+            crf_range = profile_settings['crf_range']
         
-        # Параметры масштабирования (микроизменения)
-        scale_factor = 1 + random.uniform(-0.005, 0.005)  # ±0.5%
+        # Параметры видео и GOP в пределах бюджета класса скорости
+        space = parameter_space(speed_class, crf_range)
+        multiplier = coprime_multiplier(len(space))
+        preset, b_frames, ref_frames, crf_variation, gop_size = space[
+            ((copy_number - 1) * multiplier) % len(space)
+        ]
         
-        # Параметры GOP
-        gop_size = random.randint(240, 260)
+        # Параметры масштабирования (микроизменения)
+        scale_factor = 1 + rng.uniform(-0.005, 0.005)  # ±0.5%
         
         # Параметры аудио
-        audio_bitrate = random.choice(['192k', '256k', '320k'])
-        audio_volume = 1.0 + random.uniform(-0.003, 0.003)  # ±0.3%
+        audio_bitrate = rng.choice(['192k', '256k', '320k'])
+        audio_volume = 1.0 + rng.uniform(-0.003, 0.003)  # ±0.3%
         
         # Метаданные
-        timestamp = datetime.now().timestamp() + copy_number
+        if base_time is None:
+            base_time = datetime.now().timestamp()
+        timestamp = base_time + copy_number
         unique_id = hashlib.sha256(
-            f"{copy_number}_{timestamp}_{random.random()}".encode()
+            f"{copy_number}_{timestamp}_{rng.random()}".encode()
         ).hexdigest()
         
-        return {
-            'fps': fps_base + fps_offset,
+        params = {
             'crf': crf_variation,
             'preset': preset,
             'scale_factor': scale_factor,
@@ -105,86 +712,516 @@ class VideoUniquifier:
             'unique_id': unique_id,
             'copy_number': copy_number,
             'encoder_tag': f"UniqueEncoder_v{copy_number}",
-            'pixel_format': random.choice(['yuv420p', 'yuv420p10le']),
-            'b_frames': random.randint(2, 4),
-            'ref_frames': random.randint(3, 5),
+            # 8 бит 4:2:0 воспроизводится везде и дешевле 10 бит
+            'pixel_format': 'yuv420p',
+            'b_frames': b_frames,
+            'ref_frames': ref_frames,
+            # Микро-сдвиг (субпиксельный)
+            'shift_x': rng.uniform(-0.5, 0.5),
+            'shift_y': rng.uniform(-0.5, 0.5),
+            # Параметры контейнера (для ремукса без перекодирования)
+            # Временная база видео: кадры не дублируются и не выбрасываются
+            'track_timescale': rng.choice(self._timescale_candidates(media)),
+            'ts_offset': rng.randint(1, 40) / 1000,  # 1-40 мс
+            'movflags': rng.choice([
+                '+use_metadata_tags',
+                '+disable_chpl',
+                '+use_metadata_tags+disable_chpl',
+            ]),
+            # Раскладка атомов ремукса - без faststart, который перечитывает
+            # и переписывает готовый файл
+            'container_layout': rng.choice(['reserved', 'fragmented']),
+            'major_brand': rng.choice(['isom', 'mp42', 'mp41']),
+            'has_audio': media.get('has_audio', True),
+            # Smart rendering: сколько первых GOP перекодировать и нужен ли GOP из середины
+            'smart_head_gops': rng.randint(1, 2),
+            'smart_interior': rng.random() < 0.5,
+            'smart_interior_position': rng.random(),
+        }
+        
+        params['downscale'] = self._plan_downscale(media, profile_settings)
+        params['geometry'] = self._plan_geometry(params, media)
+        params['moov_size'] = self._estimate_moov_size(media)
+        params['encode_cost'] = encode_cost(preset, b_frames, ref_frames)
+        params['estimated_cost'] = self._estimate_cost(params, media)
+        return params
+    
+    def _estimate_cost(self, params: Dict, media: Dict) -> float:
+        """
+        Предсказуемая стоимость копии для планировщика: относительная
+        стоимость кодирования * мегапиксели кадра * число кадров.
+        Без анализа входа - только относительная стоимость
+        """
+        frame = params['geometry'] or media
+        if not frame.get('width') or not media.get('duration'):
+            return params['encode_cost']
+        
+        megapixels = frame['width'] * frame['height'] / 1_000_000
+        fps = media.get('fps') or 30.0
+        return params['encode_cost'] * megapixels * fps * media['duration']
+    
+    def _estimate_moov_size(self, media: Dict) -> int:
+        """
+        Место под moov с запасом: около 20 байт таблиц сэмплов на кадр
+        видео и 8 байт на кадр AAC, плюс заголовки и метаданные.
+        Без длительности - как для часа 60 fps
+        """
+        duration = media.get('duration') or 3600
+        fps = media.get('fps') or 60
+        per_second = fps * 20 + (48000 / 1024 * 8 if media.get('has_audio', True) else 0)
+        return int((64 * 1024 + duration * per_second) * 1.5)
+    
+    def _timescale_candidates(self, media: Dict) -> List[int]:
+        """
+        Timescale, в которых длительность кадра источника - целое число
+        тиков: смена временной базы не сдвигает кадры
+        """
+        try:
+            num, den = (int(value) for value in media['frame_rate'].split('/'))
+        except (KeyError, AttributeError, ValueError):
+            return TRACK_TIMESCALES
+        if num <= 0 or den <= 0:
+            return TRACK_TIMESCALES
+        
+        candidates = [
+            timescale for timescale in TRACK_TIMESCALES
+            if timescale * den % num == 0
+        ]
+        return candidates or [num * max(1, -(-10000 // num))]
+    
+    def _pick_geometry_filter(self, width: int, height: int, fps: float) -> Tuple[str, Optional[str]]:
+        """
+        Самый качественный фильтр из GEOMETRY_FILTER_COSTS, стоимость
+        которого на пиксельной скорости входа укладывается в бюджет
+        """
+        megapixels_per_second = width * height * (fps or 30.0) / 1_000_000
+        filter_name, flags = 'crop', None
+        for name, scale_flags, cost in GEOMETRY_FILTER_COSTS:
+            if cost * megapixels_per_second <= settings.geometry_cost_budget:
+                filter_name, flags = name, scale_flags
+        return filter_name, flags
+    
+    def _plan_downscale(self, media: Dict, profile_settings: Optional[Dict]) -> Optional[Dict]:
+        """
+        Уменьшение кадра по профилю выхода: короткая сторона не больше
+        заданной, пропорции сохраняются, размеры четные
+        
+        Returns:
+            None если профиль не задан или кадр и так не больше профиля
+        """
+        width = media.get('width')
+        height = media.get('height')
+        if not profile_settings or not width or not height:
+            return None
+        
+        short_side = min(width, height)
+        if short_side <= profile_settings['short_side']:
+            return None
+        
+        ratio = profile_settings['short_side'] / short_side
+        _, flags = self._pick_geometry_filter(width, height, media.get('fps'))
+        return {
+            'width': max(2, round(width * ratio / 2) * 2),
+            'height': max(2, round(height * ratio / 2) * 2),
+            # Уменьшение - всегда scale, даже если бюджет позволяет только crop
+            'flags': flags or DOWNSCALE_FALLBACK_FLAGS,
+        }
+    
+    def _plan_geometry(self, params: Dict, media: Dict) -> Optional[Dict]:
+        """
+        Целочисленная геометрия копии для одного фильтра: фильтр и флаги -
+        самые качественные из GEOMETRY_FILTER_COSTS, укладывающиеся в бюджет
+        по пиксельной скорости входа. crop вырезает окно со сдвигом,
+        scale меняет размер на ±0.5%. Размеры всегда четные (4:2:0)
+        
+        После уменьшения по профилю кадр уже пересчитан - остается
+        только crop уменьшенного кадра
+        
+        Returns:
+            None если размер входа неизвестен
+        """
+        downscale = params.get('downscale')
+        if downscale:
+            width, height = downscale['width'], downscale['height']
+            filter_name, flags = 'crop', None
+        else:
+            width = media.get('width')
+            height = media.get('height')
+            if not width or not height:
+                return None
+            filter_name, flags = self._pick_geometry_filter(width, height, media.get('fps'))
+        
+        deviation = abs(params['scale_factor'] - 1.0)
+        
+        if filter_name == 'crop':
+            # Обрезаем 2..~1% по каждой оси, окно сдвигается целиком
+            crop_x = max(2, round(width * deviation / 2) * 2)
+            crop_y = max(2, round(height * deviation / 2) * 2)
+            return {
+                'filter': 'crop',
+                'flags': None,
+                'width': width - crop_x,
+                'height': height - crop_y,
+                'x': round((params['shift_x'] + 0.5) * crop_x),
+                'y': round((params['shift_y'] + 0.5) * crop_y),
+            }
+        
+        def scaled(size: int) -> int:
+            target = max(2, round(size * params['scale_factor'] / 2) * 2)
+            if target == size:
+                target += 2 if params['scale_factor'] >= 1 else -2
+            return target
+        
+        return {
+            'filter': 'scale',
+            'flags': flags,
+            'width': scaled(width),
+            'height': scaled(height),
+            'x': 0,
+            'y': 0,
         }
     
     def _build_ffmpeg_command(
         self, 
         input_path: Path, 
         output_path: Path, 
-        params: Dict
+        params: Dict,
+        options: Optional[Dict] = None
     ) -> List[str]:
         """
         Строит команду FFmpeg с параметрами уникализации
         """
-        command = [
-            'ffmpeg',
-            '-i', str(input_path),
-            '-y',  # Перезаписывать без подтверждения
-        ]
+        options = options or {}
         
-        # Видео параметры
-        video_filters = []
+        if options.get('tier') == ProcessingTier.CONTAINER:
+            return self._build_remux_command(input_path, output_path, params)
         
-        # Микро-масштабирование (субпиксельное)
-        if abs(params['scale_factor'] - 1.0) > 0.0001:
-            video_filters.append(
-                f"scale=iw*{params['scale_factor']}:ih*{params['scale_factor']}:flags=lanczos"
-            )
+        if options.get('tier') == ProcessingTier.BITSTREAM and params.get('video_bsf'):
+            return self._build_bitstream_command(input_path, output_path, params)
+        
+        command = ['ffmpeg']
+        command.extend(self._build_input_args(input_path, params.get('window')))
         
-        # Микро-сдвиг (субпиксельный)
-        shift_x = random.uniform(-0.5, 0.5)
-        shift_y = random.uniform(-0.5, 0.5)
-        video_filters.append(f"crop=iw-1:ih-1:{shift_x}:{shift_y}")
+        # Готовый вариант аудио из пула задачи - вторым входом
+        if params.get('audio_source'):
+            command.extend(['-i', str(params['audio_source'])])
         
-        # Добавляем один пиксель обратно чтобы сохранить размер
-        video_filters.append("pad=iw+1:ih+1:0:0")
+        command.append('-y')  # Перезаписывать без подтверждения
         
+        # Видео параметры
+        video_filters = self._build_video_filters(params)
         if video_filters:
             command.extend(['-vf', ','.join(video_filters)])
         
-        # Кодек и параметры кодирования
+        command.extend(self._build_video_codec_args(params))
+        
+        # Аудио параметры
+        if params.get('audio_source'):
+            command.extend([
+                '-map', '0:v:0',
+                '-map', '1:a:0',
+                '-c:a', 'copy',
+            ])
+        elif params['has_audio']:
+            command.extend(self._build_audio_codec_args(params))
+            command.extend(['-af', self._build_audio_filter(params)])
+        
+        command.extend(self._build_metadata_args(params))
+        command.extend(self._build_container_args(params))
+        
+        # Выходной файл
+        command.append(str(output_path))
+        
+        return command
+    
+    def _build_remux_command(
+        self,
+        input_path: Path,
+        output_path: Path,
+        params: Dict
+    ) -> List[str]:
+        """
+        Строит команду ремукса без перекодирования (-c copy): уникальность
+        достигается метаданными, creation_time, timescale дорожки,
+        сдвигом временных меток и раскладкой атомов
+        """
+        command = ['ffmpeg']
+        # Без декодирования начало окна приходится на ключевой кадр
+        command.extend(self._build_input_args(input_path, params.get('window')))
         command.extend([
+            '-y',
+            '-map', '0:v',
+            '-map', '0:a?',
+            '-c', 'copy',
+        ])
+        
+        command.extend(self._build_metadata_args(params))
+        
+        command.extend(['-output_ts_offset', str(params['ts_offset'])])
+        
+        # Опции muxer'а mov/mp4 - для других контейнеров их нет
+        movflags = ''
+        if output_path.suffix.lower() in ('.mp4', '.mov'):
+            command.extend(['-brand', params['major_brand']])
+            movflags = params['movflags']
+        
+        command.extend(self._build_container_args(params, movflags))
+        command.append(str(output_path))
+        
+        return command
+    
+    def _build_bitstream_command(
+        self,
+        input_path: Path,
+        output_path: Path,
+        params: Dict
+    ) -> List[str]:
+        """
+        Строит команду без перекодирования, меняющую сам видеопоток:
+        SEI и поля VUI/SPS правятся bitstream-фильтром
+        """
+        command = ['ffmpeg']
+        command.extend(self._build_input_args(input_path, params.get('window')))
+        
+        # Аудио из пула задачи или исходное
+        if params.get('audio_source'):
+            command.extend(['-i', str(params['audio_source'])])
+        
+        command.extend([
+            '-y',
+            '-map', '0:v:0',
+            '-map', '1:a:0' if params.get('audio_source') else '0:a?',
+            '-c', 'copy',
+            '-bsf:v', params['video_bsf'],
+        ])
+        
+        command.extend(self._build_metadata_args(params))
+        command.extend(self._build_container_args(params))
+        command.append(str(output_path))
+        
+        return command
+    
+    def _build_batch_ffmpeg_command(
+        self,
+        input_path: Path,
+        output_paths: List[Path],
+        params_list: List[Dict],
+        has_audio: bool
+    ) -> List[str]:
+        """
+        Строит одну команду FFmpeg на несколько копий: видео (и аудио)
+        раздваивается через split/asplit в filter_complex, у каждого
+        выхода свои фильтры, параметры кодирования и метаданные
+        """
+        count = len(output_paths)
+        
+        command = ['ffmpeg']
+        command.extend(self._build_input_args(input_path, params_list[0].get('window')))
+        
+        # Варианты аудио из пула - отдельными входами, без asplit
+        audio_inputs = {}
+        for params in params_list:
+            audio_source = params.get('audio_source')
+            if audio_source and audio_source not in audio_inputs:
+                audio_inputs[audio_source] = len(audio_inputs) + 1
+                command.extend(['-i', str(audio_source)])
+        
+        command.append('-y')
+        
+        graph = []
+        
+        # Уменьшение по профилю общее для задачи - один раз до split
+        downscale = params_list[0].get('downscale')
+        shared_filters = f"{self._build_downscale_filter(params_list[0])}," if downscale else ''
+        
+        split_labels = ''.join(f"[vsplit{i}]" for i in range(count))
+        graph.append(f"[0:v]{shared_filters}split={count}{split_labels}")
+        for i, params in enumerate(params_list):
+            video_filters = self._build_video_filters(params, include_downscale=not downscale) or ['null']
+            graph.append(f"[vsplit{i}]{','.join(video_filters)}[vout{i}]")
+        
+        if has_audio and not audio_inputs:
+            split_labels = ''.join(f"[asplit{i}]" for i in range(count))
+            graph.append(f"[0:a]asplit={count}{split_labels}")
+            for i, params in enumerate(params_list):
+                graph.append(f"[asplit{i}]{self._build_audio_filter(params)}[aout{i}]")
+        
+        command.extend(['-filter_complex', ';'.join(graph)])
+        
+        # Параметры каждого выхода идут перед его именем файла
+        for i, (output_path, params) in enumerate(zip(output_paths, params_list)):
+            command.extend(['-map', f"[vout{i}]"])
+            command.extend(self._build_video_codec_args(params))
+            
+            if params.get('audio_source'):
+                command.extend([
+                    '-map', f"{audio_inputs[params['audio_source']]}:a:0",
+                    '-c:a', 'copy',
+                ])
+            elif has_audio:
+                command.extend(['-map', f"[aout{i}]"])
+                command.extend(self._build_audio_codec_args(params))
+            
+            command.extend(self._build_metadata_args(params))
+            command.extend(self._build_container_args(params))
+            command.append(str(output_path))
+        
+        return command
+    
+    def _build_input_args(self, input_path: Path, window: Optional[Dict] = None) -> List[str]:
+        """
+        Вход FFmpeg. Окно задачи применяется поиском по входу (-ss/-t
+        перед -i): неиспользуемая часть файла не декодируется
+        """
+        args = []
+        if window:
+            args.extend([
+                '-ss', f"{window['start']:.6f}",
+                '-t', f"{window['duration']:.6f}",
+            ])
+        args.extend(['-i', str(input_path)])
+        return args
+    
+    def _build_video_filters(self, params: Dict, include_downscale: bool = True) -> List[str]:
+        """
+        Фильтры видео для одной копии: уменьшение по профилю первым
+        (кодеру и следующему фильтру достается меньше пикселей), затем
+        один проход с целочисленной геометрией из _plan_geometry
+        """
+        video_filters = []
+        
+        if include_downscale and params.get('downscale'):
+            video_filters.append(self._build_downscale_filter(params))
+        
+        geometry = params.get('geometry')
+        
+        if geometry is None:
+            # Размер входа неизвестен - масштаб с округлением до четного
+            video_filters.append(
+                f"scale=trunc(iw*{params['scale_factor']}/2)*2:"
+                f"trunc(ih*{params['scale_factor']}/2)*2:flags=bicubic"
+            )
+        elif geometry['filter'] == 'crop':
+            video_filters.append(
+                f"crop={geometry['width']}:{geometry['height']}:{geometry['x']}:{geometry['y']}"
+            )
+        else:
+            video_filters.append(
+                f"scale={geometry['width']}:{geometry['height']}:flags={geometry['flags']}"
+            )
+        
+        return video_filters
+    
+    def _build_downscale_filter(self, params: Dict) -> str:
+        """Уменьшение кадра по профилю выхода"""
+        downscale = params['downscale']
+        return f"scale={downscale['width']}:{downscale['height']}:flags={downscale['flags']}"
+    
+    def _build_video_codec_args(self, params: Dict) -> List[str]:
+        """
+        Кодек и параметры кодирования видео
+        """
+        args = [
             '-c:v', 'libx264',
             '-preset', params['preset'],
-            '-crf', str(params['crf']),
+        ]
+        
+        # Двухпроходный режим: целевой битрейт и общая статистика задачи
+        if params.get('video_pass'):
+            args.extend([
+                '-b:v', f"{params['video_bitrate_kbps']}k",
+                '-pass', str(params['video_pass']),
+                '-passlogfile', str(params['passlogfile']),
+            ])
+        else:
+            args.extend(['-crf', str(params['crf'])])
+        
+        # VBV: пиковый битрейт и размер буфера ограничивают размер копии
+        if params.get('max_bitrate_kbps'):
+            args.extend([
+                '-maxrate', f"{params['max_bitrate_kbps']}k",
+                '-bufsize', f"{params['max_bitrate_kbps'] * 2}k",
+            ])
+        
+        args.extend([
             '-g', str(params['gop_size']),  # GOP size
             '-bf', str(params['b_frames']),  # B-frames
             '-refs', str(params['ref_frames']),  # Reference frames
             '-pix_fmt', params['pixel_format'],
+            # Кадры как у источника, уникальна только временная база
+            '-fps_mode', 'passthrough',
         ])
-        
-        # FPS
-        command.extend(['-r', str(params['fps'])])
-        
-        # Аудио параметры
-        command.extend([
+        if params.get('track_timescale'):
+            args.extend(['-enc_time_base:v', f"1/{params['track_timescale']}"])
+        if params.get('rc_lookahead'):
+            args.extend(['-rc-lookahead', str(params['rc_lookahead'])])
+        return args
+    
+    def _build_audio_codec_args(self, params: Dict) -> List[str]:
+        """
+        Кодек и битрейт аудио
+        """
+        return [
             '-c:a', 'aac',
             '-b:a', params['audio_bitrate'],
-            '-af', f"volume={params['audio_volume']}",
-        ])
-        
-        # Метаданные
-        command.extend([
+        ]
+    
+    def _build_audio_filter(self, params: Dict) -> str:
+        """
+        Фильтр громкости аудио (микроизменение)
+        """
+        return f"volume={params['audio_volume']}"
+    
+    def _build_metadata_args(self, params: Dict) -> List[str]:
+        """
+        Метаданные копии
+        """
+        return [
             '-metadata', f"creation_time={params['creation_time']}",
             '-metadata', f"encoder={params['encoder_tag']}",
             '-metadata', f"comment=Unique_Copy_{params['copy_number']}",
             '-metadata', f"unique_id={params['unique_id']}",
             '-metadata', f"title=Video_{params['copy_number']:03d}",
-        ])
-        
-        # Дополнительные параметры для уникальности
-        command.extend([
-            '-movflags', '+faststart',
-            '-fflags', '+genpts',
-        ])
+        ]
+    
+    def _build_container_args(self, params: Dict, movflags: str = '') -> List[str]:
+        """
+        Дополнительные параметры контейнера: раскладка moov без
+        второго прохода по файлу, где это возможно. movflags копии
+        добавляются к флагам раскладки (FFmpeg берет только последний -movflags)
+        """
+        args = []
+        layout = params.get('output_layout')
         
-        # Выходной файл
-        command.append(str(output_path))
+        if layout == 'reserved':
+            # moov пишется в зарезервированное место в начале файла
+            args.extend(['-moov_size', str(params['moov_size'])])
+        elif layout == 'fragmented':
+            movflags = FRAGMENTED_MOVFLAGS + movflags
+        elif layout == 'stream':
+            movflags = STREAM_MOVFLAGS + movflags
+            args.extend(['-frag_duration', str(STREAM_FRAGMENT_US)])
+        elif layout == 'faststart':
+            movflags = '+faststart' + movflags
         
-        return command
+        if movflags:
+            args.extend(['-movflags', movflags])
+        # Timescale дорожки задается muxer'у: после склейки сегментов из
+        # mpegts иначе всегда остается 90 кГц (только MP4/MOV, иначе None)
+        if params.get('track_timescale'):
+            args.extend(['-video_track_timescale', str(params['track_timescale'])])
+        args.extend(['-fflags', '+genpts'])
+        return args
+    
+    def supports_bitstream_tier(self, codec_name: Optional[str]) -> bool:
+        """Можно ли уникализировать поток кодека bitstream-фильтром"""
+        return codec_name in BITSTREAM_FILTERS
+    
+    def _apply_strategies(self, params: Dict) -> Dict:
+        """Последовательно применяет стратегии уникализации"""
+        for strategy in self.uniquification_strategies:
+            params = strategy(params)
+        return params
     
     def _strategy_metadata(self, params: Dict) -> Dict:
         """Стратегия уникализации через метаданные"""
@@ -195,7 +1232,37 @@ class VideoUniquifier:
         return params
     
     def _strategy_video_stream(self, params: Dict) -> Dict:
-        """Стратегия уникализации видео потока"""
+        """
+        Стратегия уникализации видео потока: для H.264/HEVC, подтвержденных
+        пробой, собирает bitstream-фильтр с уникальным SEI (user data
+        unregistered) и правкой полей VUI/SPS
+        """
+        codec = params.get('source_codec')
+        if codec not in BITSTREAM_FILTERS:
+            return params
+        
+        bsf_options = []
+        # Выбор зависит только от копии - команда воспроизводима
+        rng = random.Random(params['unique_id'])
+        
+        # hevc_metadata не умеет вставлять SEI - только правка VUI
+        if codec == 'h264':
+            unique_id = params['unique_id']
+            bsf_options.append(f"sei_user_data={unique_id[:32]}+{unique_id[32:]}")
+        
+        # Access unit delimiters: вставить, убрать или оставить как есть
+        aud = rng.choice(['insert', 'remove', None])
+        if aud:
+            bsf_options.append(f"aud={aud}")
+        
+        # video_format в VUI (0-4 - аналоговые стандарты, 5 - не указан)
+        bsf_options.append(f"video_format={rng.randint(0, 5)}")
+        
+        # Явный chroma_sample_loc_type=0 совпадает со значением по умолчанию
+        if rng.random() < 0.5:
+            bsf_options.append("chroma_sample_loc_type=0")
+        
+        params['video_bsf'] = f"{BITSTREAM_FILTERS[codec]}={':'.join(bsf_options)}"
         return params
     
     def _strategy_audio_stream(self, params: Dict) -> Dict:
@@ -0,0 +1,232 @@
+import math
+import shutil
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.process_priority import with_priority
+from app.models import SpeedClass, OutputProfile
+from app.services.media_probe import analyze_media, apply_window
+from app.services.segment_encoder import choose_segment_bounds
+from app.services.uniquifier import coprime_multiplier, varies_time_base
+
+
+class SegmentVariantAssembler:
+    """
+    Комбинаторная сборка копий: вход режется на S сегментов по ключевым
+    кадрам, каждый сегмент кодируется в V вариантах, а копия собирается
+    выбором одного варианта на сегмент. S*V кодирований дают V^S копий
+    """
+    
+    def __init__(
+        self,
+        uniquifier,
+        input_path: Path,
+        work_dir: Path,
+        total_copies: int,
+        speed_class: SpeedClass = SpeedClass.BALANCED,
+        max_bitrate_kbps: Optional[int] = None,
+        window: Optional[Dict] = None,
+        output_format: str = 'mp4',
+        profile: OutputProfile = OutputProfile.SOURCE
+    ):
+        self.uniquifier = uniquifier
+        self.input_path = input_path
+        self.work_dir = work_dir
+        self.total_copies = total_copies
+        self.speed_class = speed_class
+        self.max_bitrate_kbps = max_bitrate_kbps
+        self.output_format = output_format
+        self.profile = profile
+        # Окно задачи: сегменты отсчитываются от его начала
+        self.window = window
+        self.offset = window['start'] if window else 0.0
+        self.bounds: List[Tuple[float, float]] = []
+        self.variant_count = 0
+        # (номер сегмента, номер варианта) -> файл
+        self.variants: Dict[Tuple[int, int], Path] = {}
+        # Кодирования вариантов: (начало, конец, файл, параметры)
+        self.jobs: List[Tuple[float, float, Path, Dict]] = []
+        self.multiplier = 1
+        self.media: Dict = {}
+    
+    def prepare(self) -> bool:
+        """
+        Выбирает S и V и планирует S*V кодирований вариантов сегментов
+        (self.jobs). Кодирует их вызывающий - через encode_variant в общем
+        пуле кодирования
+        
+        Returns:
+            False если вход слишком короткий для нужного числа комбинаций
+        """
+        self.media = apply_window(analyze_media(self.input_path, with_keyframes=True), self.window)
+        duration = self.media['duration']
+        keyframes = [
+            keyframe - self.media['start_time']
+            for keyframe in self.media['keyframes']
+        ]
+        if not keyframes or duration <= 0:
+            return False
+        
+        max_segments = min(
+            settings.variant_max_segments,
+            len(keyframes),
+            int(duration // max(1, settings.variant_min_segment_duration)),
+        )
+        if max_segments < 1:
+            return False
+        
+        # Минимальное V при максимальном S, затем минимальное S при этом V
+        self.variant_count = max(2, math.ceil(self.total_copies ** (1 / max_segments)))
+        segment_count = 1
+        while self.variant_count ** segment_count < self.total_copies:
+            segment_count += 1
+        
+        self.bounds = choose_segment_bounds(keyframes, duration, segment_count)
+        if self.variant_count ** len(self.bounds) < self.total_copies:
+            return False  # ключевые кадры слишком редкие
+        
+        self.multiplier = coprime_multiplier(self.variant_count ** len(self.bounds))
+        
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self._plan_variants()
+        return True
+    
+    def _plan_variants(self):
+        """
+        Параметры всех вариантов всех сегментов
+        """
+        base_params = self.uniquifier._generate_unique_params(
+            1, self.variant_count, self.media, self.speed_class, self.profile
+        )
+        if not varies_time_base(self.output_format):
+            base_params['track_timescale'] = None
+        for variant in range(self.variant_count):
+            params = self.uniquifier._generate_unique_params(
+                variant + 1, self.variant_count, self.media, self.speed_class, self.profile
+            )
+            # Склеиваемые варианты обязаны совпадать по размеру, pix_fmt и временной базе
+            params.update({
+                'downscale': base_params['downscale'],
+                'geometry': base_params['geometry'],
+                'pixel_format': base_params['pixel_format'],
+                'track_timescale': base_params['track_timescale'],
+                'max_bitrate_kbps': self.max_bitrate_kbps,
+            })
+            
+            for segment, (start, end) in enumerate(self.bounds):
+                output_path = self.work_dir / f"segment_{segment:03d}_variant_{variant:03d}.ts"
+                self.variants[(segment, variant)] = output_path
+                self.jobs.append((start, end, output_path, params))
+    
+    def variant_cost(self, job: Tuple[float, float, Path, Dict]) -> float:
+        """
+        Единицы работы варианта для модели стоимости - как у копии
+        длиной в сегмент
+        """
+        start, end, _, params = job
+        return self.uniquifier._estimate_cost(params, dict(self.media, duration=end - start))
+    
+    def encode_variant(self, start: float, end: float, output_path: Path, params: Dict):
+        """
+        Кодирует один вариант сегмента [start, end)
+        """
+        command = [
+            'ffmpeg',
+            '-ss', f"{self.offset + start:.6f}",
+            '-i', str(self.input_path),
+            '-t', f"{end - start:.6f}",
+            '-y',
+            '-map', '0:v:0',
+        ]
+        
+        video_filters = self.uniquifier._build_video_filters(params)
+        if video_filters:
+            command.extend(['-vf', ','.join(video_filters)])
+        
+        command.extend(self.uniquifier._build_video_codec_args(params))
+        command.extend([
+            # SPS/PPS перед каждым IDR - варианты с разными настройками
+            # x264 корректно декодируются после склейки
+            '-x264-params', 'repeat-headers=1',
+            '-threads', str(settings.segment_encoder_threads),
+            '-f', 'mpegts',
+            str(output_path),
+        ])
+        
+        self._run(command)
+    
+    def choose_variants(self, copy_number: int) -> List[int]:
+        """
+        Номера вариантов по сегментам для копии. Индекс копии переводится
+        биекцией (a*i mod V^S) и раскладывается по основанию V, поэтому
+        любые две копии различаются хотя бы в одном сегменте
+        """
+        combinations = self.variant_count ** len(self.bounds)
+        index = ((copy_number - 1) * self.multiplier) % combinations
+        
+        digits = []
+        for _ in self.bounds:
+            digits.append(index % self.variant_count)
+            index //= self.variant_count
+        return digits
+    
+    def create_copy(self, output_path: Path, params: Dict) -> bool:
+        """
+        Собирает копию из готовых вариантов сегментов без перекодирования
+        """
+        concat_list = self.work_dir / f"concat_{params['copy_number']:05d}.txt"
+        
+        try:
+            concat_list.write_text(''.join(
+                f"file '{self.variants[(segment, variant)].resolve()}'\n"
+                for segment, variant in enumerate(self.choose_variants(params['copy_number']))
+            ))
+            
+            command = [
+                'ffmpeg',
+                '-f', 'concat',
+                '-safe', '0',
+                '-i', str(concat_list),
+            ]
+            # Аудио из пула задачи или исходное (в пределах окна)
+            if params.get('audio_source'):
+                command.extend(['-i', str(params['audio_source'])])
+            else:
+                command.extend(self.uniquifier._build_input_args(self.input_path, self.window))
+            command.extend([
+                '-y',
+                '-map', '0:v:0',
+                '-map', '1:a?',
+                '-c', 'copy',
+            ])
+            command.extend(self.uniquifier._build_metadata_args(params))
+            command.extend(self.uniquifier._build_container_args(params))
+            command.append(str(output_path))
+            
+            self._run(command)
+            return output_path.exists()
+        
+        except subprocess.CalledProcessError as e:
+            print(f"FFmpeg variant assembly error: {e.stderr}")
+            params['ffmpeg_error'] = e.stderr
+            return False
+        except Exception as e:
+            print(f"Error assembling variants: {str(e)}")
+            return False
+        finally:
+            concat_list.unlink(missing_ok=True)
+    
+    def _run(self, command: List[str]):
+        """Запускает FFmpeg, при ошибке бросает CalledProcessError"""
+        subprocess.run(
+            with_priority(command),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    
+    def cleanup(self):
+        """Удаляет варианты сегментов"""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -1,13 +1,31 @@
 import asyncio
+import json
+import math
+import os
+import re
 import shutil
+import subprocess
+import threading
 import zipfile
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 from datetime import datetime, timedelta
 import uuid
 import logging
+from functools import partial
 
+from app.models import ProcessingTier, SpeedClass, RateControl, OutputProfile, Delivery, PriorityClass
 from app.services.uniquifier import VideoUniquifier
+from app.services.mp4_patcher import Mp4BoxPatcher, SUPPORTED_EXTENSIONS
+from app.services.media_probe import analyze_media, apply_window
+from app.services.mezzanine import should_use_mezzanine, create_mezzanine
+from app.services.smart_renderer import SmartRenderer
+from app.services.segment_encoder import ParallelSegmentEncoder, plan_segment_count
+from app.services.variant_assembler import SegmentVariantAssembler
+from app.services.copy_cache import CopyCache
+from app.services.encode_pool import EncodePool
+from app.services.cost_model import EncodeCostModel
+from app.services.process_priority import set_task_priority, with_priority
 from app.config import settings
 from app.utils.file_handler import cleanup_file
 
@@ -15,6 +33,19 @@ from app.utils.file_handler import cleanup_file
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Имя файла копии: номер копии и расширение
+COPY_FILENAME = re.compile(r'^video_(\d+)\.(\w+)$')
+
+# Опции задачи по запросу, которые сохраняются в манифесте на диске
+MANIFEST_OPTIONS = (
+    'tier', 'media', 'speed_class', 'profile', 'window',
+    'output_format', 'base_time', 'size_cap', 'audio_pool',
+)
+
+# Потоковая выдача: наибольший кусок stdout и сколько кусков ждут клиента
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_QUEUE_CHUNKS = 8
+
 
 class VideoProcessor:
     """
@@ -25,6 +56,14 @@ class VideoProcessor:
         self.uniquifier = VideoUniquifier()
         self.active_tasks: Dict[str, Dict] = {}
         self.cleanup_task = None
+        # Копии всех задач кодируются через общий ограниченный пул,
+        # первыми - задачи с наименьшим предсказанным остатком
+        self.cost_model = EncodeCostModel()
+        self.encode_pool = EncodePool(settings.encode_slots)
+        # Копии задач с отложенной сборкой и блокировки их сборки
+        self.copy_cache = CopyCache(settings.lazy_cache_bytes)
+        # Путь копии -> блокировка и число запросов, которые ее держат или ждут
+        self.materialize_locks: Dict[Path, Dict] = {}
     
     async def start_cleanup_scheduler(self):
         """
@@ -45,7 +84,7 @@ class VideoProcessor:
                 
                 logger.info("Running scheduled cleanup...")
                 await self.cleanup_old_tasks(hours=settings.temp_file_cleanup_hours)
-                
+            
             except asyncio.CancelledError:
                 logger.info("Cleanup scheduler cancelled")
                 break
@@ -56,7 +95,19 @@ class VideoProcessor:
         self, 
         input_file: Path, 
         copies_count: int,
-        output_format: str = "mp4"
+        output_format: str = "mp4",
+        tier: ProcessingTier = ProcessingTier.FULL,
+        speed_class: SpeedClass = SpeedClass.BALANCED,
+        rate_control: RateControl = RateControl.CRF,
+        target_bitrate_kbps: Optional[int] = None,
+        max_bitrate_kbps: Optional[int] = None,
+        max_size_percent: Optional[float] = None,
+        output_profile: OutputProfile = OutputProfile.SOURCE,
+        start: Optional[float] = None,
+        duration: Optional[float] = None,
+        delivery: Delivery = Delivery.ARCHIVE,
+        client: str = 'default',
+        priority: PriorityClass = PriorityClass.STANDARD
     ) -> str:
         """
         Обрабатывает видео и создает N уникальных копий
@@ -78,16 +129,31 @@ class VideoProcessor:
             'status': 'processing',
             'progress': 0,
             'total': copies_count,
+            'tier': tier,
+            'speed_class': speed_class,
+            'rate_control': rate_control,
+            'output_profile': output_profile,
+            'delivery': delivery,
             'files': [],
+            'sizes': [],
             'created_at': datetime.now(),
             'last_accessed': datetime.now(),
             'task_dir': str(task_dir),
             'input_file': str(input_file),
+            'output_format': output_format,
+            # Ключ клиента для справедливой очереди и ожидание копий в ней
+            'client': client,
+            'queue_wait': {},
+            'priority': priority,
         }
         
         # Запускаем обработку в фоне
         asyncio.create_task(
-            self._process_task(task_id, input_file, copies_count, task_dir, output_format)
+            self._process_task(
+                task_id, input_file, copies_count, task_dir, output_format,
+                tier, speed_class, rate_control, target_bitrate_kbps,
+                max_bitrate_kbps, max_size_percent, output_profile, start, duration, delivery
+            )
         )
         
         return task_id
@@ -98,47 +164,296 @@ class VideoProcessor:
         input_file: Path,
         copies_count: int,
         task_dir: Path,
-        output_format: str
+        output_format: str,
+        tier: ProcessingTier = ProcessingTier.FULL,
+        speed_class: SpeedClass = SpeedClass.BALANCED,
+        rate_control: RateControl = RateControl.CRF,
+        target_bitrate_kbps: Optional[int] = None,
+        max_bitrate_kbps: Optional[int] = None,
+        max_size_percent: Optional[float] = None,
+        output_profile: OutputProfile = OutputProfile.SOURCE,
+        start: Optional[float] = None,
+        duration: Optional[float] = None,
+        delivery: Delivery = Delivery.ARCHIVE
     ):
         """
         Внутренний метод для обработки задачи
         """
+        smart_renderer = None
+        segment_encoder = None
+        variant_assembler = None
+        mezzanine_file = None
+        # Потоковой и отложенной выдаче вход и пул аудио нужны до конца жизни задачи
+        keep_sources = delivery in (Delivery.STREAM, Delivery.LAZY)
+        
         try:
+            # Подготовительные стадии задачи запускают FFmpeg с ее nice/ionice
+            set_task_priority(self.active_tasks[task_id]['priority'])
             logger.info(f"Starting processing task {task_id}")
             logger.info(f"Input file exists: {input_file.exists()}, size: {input_file.stat().st_size if input_file.exists() else 0}")
             
             created_files = []
             
-            for i in range(1, copies_count + 1):
-                output_filename = f"video_{i:03d}.{output_format}"
-                output_path = task_dir / output_filename
+            # Один ffprobe на загрузку (кэш по отпечатку содержимого)
+            full_media = await asyncio.to_thread(analyze_media, input_file)
+            
+            # Фрагмент входа: дальше все стадии работают только с ним
+            window = self._plan_window(full_media, start, duration)
+            media = apply_window(full_media, window)
+            if window:
+                logger.info(f"Task {task_id}: window {window['start']:.3f}s + {window['duration']:.3f}s")
+            
+            options = {
+                'tier': tier,
+                'media': media,
+                'speed_class': speed_class,
+                'profile': output_profile,
+                'window': window,
+                'output_format': output_format,
+                # Общее время задачи: копия с номером N одинакова в архиве,
+                # в потоке и при отложенной сборке
+                'base_time': self.active_tasks[task_id]['created_at'].timestamp(),
+            }
+            
+            # Лимит размера копии переводится в VBV-ограничение битрейта
+            # (процент считается от доли входа, попавшей в окно)
+            input_size = input_file.stat().st_size
+            if window and full_media['duration'] > 0:
+                input_size = int(input_size * window['duration'] / full_media['duration'])
+            options['size_cap'] = self.uniquifier.plan_size_cap(
+                media, input_size, max_bitrate_kbps, max_size_percent
+            )
+            if options['size_cap']:
+                logger.info(
+                    f"Task {task_id}: video capped at {options['size_cap']['max_bitrate_kbps']} kbps, "
+                    f"target size {options['size_cap']['target_bytes']} bytes"
+                )
+            
+            if delivery == Delivery.STREAM:
+                await self._prepare_stream_task(task_id, input_file, task_dir, options)
+                return
+            if delivery == Delivery.LAZY:
+                await self._prepare_lazy_task(task_id, input_file, task_dir, output_format, options)
+                return
+            
+            # Патчер атомов и smart rendering работают с файлом целиком
+            if window and tier == ProcessingTier.METADATA:
+                logger.warning(f"Task {task_id}: metadata tier cannot cut a window, using container tier")
+                tier = ProcessingTier.CONTAINER
+                options['tier'] = tier
+                self.active_tasks[task_id]['tier'] = tier
+            if window and tier == ProcessingTier.SMART:
+                logger.warning(f"Task {task_id}: smart rendering cannot cut a window, using full re-encode")
+                tier = ProcessingTier.FULL
+                options['tier'] = tier
+                self.active_tasks[task_id]['tier'] = tier
+            
+            if tier == ProcessingTier.METADATA:
+                options['box_patcher'] = await self._prepare_box_patcher(input_file, output_format)
+                if options['box_patcher'] is None:
+                    logger.warning(f"Task {task_id}: metadata tier is not applicable, using container tier")
+                    tier = ProcessingTier.CONTAINER
+                    options['tier'] = tier
+                    self.active_tasks[task_id]['tier'] = tier
+            
+            if tier == ProcessingTier.BITSTREAM:
+                options['video_codec'] = media['video_codec']
                 
-                logger.info(f"Creating unique copy {i}/{copies_count}: {output_path}")
+                if not self.uniquifier.supports_bitstream_tier(options['video_codec']):
+                    logger.warning(
+                        f"Task {task_id}: codec {options['video_codec']} is not supported "
+                        f"by bitstream tier, using full re-encode"
+                    )
+                    tier = ProcessingTier.FULL
+                    options['tier'] = tier
+                    self.active_tasks[task_id]['tier'] = tier
+            
+            if tier == ProcessingTier.SMART:
+                smart_renderer = SmartRenderer(
+                    self.uniquifier, input_file, task_dir / '.smart', copies_count, speed_class
+                )
+                options['smart_renderer'] = smart_renderer
                 
-                # Создаем уникальную копию
-                success = await asyncio.to_thread(
-                    self.uniquifier.create_unique_copy,
-                    input_file,
-                    output_path,
-                    i,
-                    copies_count
+                if not await self._prepare_smart_renderer(task_id, smart_renderer):
+                    logger.warning(f"Task {task_id}: input is not suitable for smart rendering, using full re-encode")
+                    tier = ProcessingTier.FULL
+                    options['tier'] = tier
+                    self.active_tasks[task_id]['tier'] = tier
+            
+            # Дорогой для декодирования вход один раз переводится в FFV1,
+            # и все копии читают уже его
+            source_file = input_file
+            if tier in (ProcessingTier.FULL, ProcessingTier.COMBINATORIAL):
+                mezzanine_file = await self._prepare_mezzanine(
+                    task_id, input_file, media, copies_count, tier, window
                 )
+                if mezzanine_file:
+                    # Промежуточный файл уже содержит только окно
+                    source_file = mezzanine_file
+                    window = None
+                    options['window'] = None
+            
+            if tier == ProcessingTier.COMBINATORIAL:
+                variant_assembler = SegmentVariantAssembler(
+                    self.uniquifier, source_file, task_dir / '.variants', copies_count, speed_class,
+                    options['size_cap']['max_bitrate_kbps'] if options['size_cap'] else None,
+                    window,
+                    output_format,
+                    output_profile
+                )
+                options['variant_assembler'] = variant_assembler
                 
-                if success and output_path.exists():
-                    created_files.append(output_filename)
-                    logger.info(f"Successfully created {output_filename}, size: {output_path.stat().st_size} bytes")
+                logger.info(f"Task {task_id}: encoding segment variants")
+                if not await self._prepare_variant_assembler(task_id, variant_assembler):
+                    if copies_count > settings.max_copies_count:
+                        raise Exception("Видео слишком короткое для такого количества комбинаций")
+                    logger.warning(f"Task {task_id}: combinatorial assembly is not possible, using full re-encode")
+                    tier = ProcessingTier.FULL
+                    options['tier'] = tier
+                    self.active_tasks[task_id]['tier'] = tier
                 else:
-                    logger.error(f"Failed to create {output_filename}")
+                    logger.info(
+                        f"Task {task_id}: {len(variant_assembler.bounds)} segments x "
+                        f"{variant_assembler.variant_count} variants"
+                    )
+            
+            # Первый проход один на задачу, копии делают только второй
+            if tier == ProcessingTier.FULL and rate_control == RateControl.TWO_PASS:
+                options['two_pass'] = await self._prepare_first_pass(
+                    task_id, source_file, media, speed_class, target_bitrate_kbps,
+                    output_profile, output_format, window, task_dir / '.twopass'
+                )
+                if options['two_pass'] is None:
+                    logger.warning(f"Task {task_id}: first pass failed, using CRF")
+                    self.active_tasks[task_id]['rate_control'] = RateControl.CRF
+            
+            # Статистика первого прохода описывает вход целиком - сегменты с ней несовместимы
+            if tier == ProcessingTier.FULL and not options.get('two_pass'):
+                segment_encoder = ParallelSegmentEncoder(
+                    self.uniquifier, source_file, task_dir / '.segments', window
+                )
+                if await self._prepare_segment_encoder(task_id, segment_encoder):
+                    logger.info(
+                        f"Task {task_id}: encoding each copy in "
+                        f"{len(segment_encoder.bounds)} parallel segments"
+                    )
+                    options['segment_encoder'] = segment_encoder
+            
+            # Аудио кодируется один раз на задачу небольшим пулом вариантов,
+            # копии берут готовую дорожку (контейнерные режимы аудио не трогают)
+            if tier not in (ProcessingTier.CONTAINER, ProcessingTier.METADATA):
+                options['audio_pool'] = await self._prepare_audio_pool(
+                    task_id, source_file, task_dir / '.audio', window
+                )
+            
+            # Пачки нужны только при перекодировании - ремукс и так быстрый,
+            # а длинный вход уже загружает все ядра сегментами
+            batch_size = max(1, settings.encode_batch_size)
+            if tier != ProcessingTier.FULL or options.get('segment_encoder'):
+                batch_size = 1
+            # Лог прохода FFmpeg называет по индексу выходного потока: у копий
+            # пачки кроме первой нет статистики первого прохода
+            if options.get('two_pass'):
+                batch_size = 1
+            
+            batches = [
+                [
+                    (i, task_dir / f"video_{i:03d}.{output_format}")
+                    for i in range(batch_start, min(batch_start + batch_size, copies_count + 1))
+                ]
+                for batch_start in range(1, copies_count + 1, batch_size)
+            ]
+            # Работа каждой копии для модели стоимости (параметры детерминированы)
+            units = {
+                i: self.uniquifier._generate_copy_params(i, copies_count, options)['estimated_cost']
+                for i in range(1, copies_count + 1)
+            }
+            self.active_tasks[task_id]['estimated_seconds'] = round(sum(
+                self.cost_model.predict(
+                    self._cost_key(options, len(outputs)),
+                    sum(units[i] for i, _ in outputs),
+                    len(outputs)
+                )
+                for outputs in batches
+            ), 1)
+            
+            # Номер копии -> имя файла и размер; списки задачи строятся по номерам
+            created: Dict[int, str] = {}
+            sizes: Dict[int, Dict] = {}
+            in_flight: Dict[asyncio.Task, List] = {}
+            next_batch = 0
+            
+            try:
+                while next_batch < len(batches) or in_flight:
+                    # Пачек задачи в работе: уже запущенные плюс сколько пачек
+                    # помещается в свободные слоты пула (хотя бы одна, чтобы задача
+                    # двигалась и при занятом пуле). Сегментированная копия сама
+                    # занимает все ядра
+                    free_slots = self.encode_pool.free_slots(self.active_tasks[task_id]['priority'])
+                    limit = len(in_flight) + max(1, free_slots // batch_size)
+                    if options.get('segment_encoder'):
+                        limit = 1
+                    while next_batch < len(batches) and len(in_flight) < limit:
+                        outputs = batches[next_batch]
+                        # Ранг пачки - предсказанный остаток задачи вместе с ней
+                        remaining = [i for batch in batches[next_batch:] for i, _ in batch]
+                        rank = self.cost_model.predict(
+                            self._cost_key(options, len(outputs)),
+                            sum(units[i] for i in remaining),
+                            len(remaining)
+                        )
+                        next_batch += 1
+                        logger.info(f"Creating unique copies {outputs[0][0]}-{outputs[-1][0]}/{copies_count}")
+                        
+                        batch_task = asyncio.create_task(
+                            self._encode_outputs(
+                                task_id, source_file, outputs, copies_count, options,
+                                sum(units[i] for i, _ in outputs), rank
+                            )
+                        )
+                        in_flight[batch_task] = outputs
                     
-                # Обновляем прогресс
-                self.active_tasks[task_id]['progress'] = i
-                self.active_tasks[task_id]['files'] = created_files
-                self.active_tasks[task_id]['last_accessed'] = datetime.now()
-                
-                # Небольшая пауза чтобы не перегружать систему
-                await asyncio.sleep(0.1)
+                    done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    
+                    for batch_task in done:
+                        outputs = in_flight.pop(batch_task)
+                        results = batch_task.result()
+                        
+                        for i, output_path in outputs:
+                            if results.get(i) and output_path.exists():
+                                created[i] = output_path.name
+                                size_bytes = output_path.stat().st_size
+                                target_bytes = options['size_cap']['target_bytes'] if options['size_cap'] else None
+                                sizes[i] = {
+                                    'file': output_path.name,
+                                    'size_bytes': size_bytes,
+                                    'target_bytes': target_bytes,
+                                }
+                                logger.info(f"Successfully created {output_path.name}, size: {size_bytes} bytes")
+                                if target_bytes and size_bytes > target_bytes:
+                                    logger.warning(f"{output_path.name} exceeds target size {target_bytes} bytes")
+                            else:
+                                logger.error(f"Failed to create {output_path.name}")
+                        
+                        # Обновляем прогресс
+                        self.active_tasks[task_id]['progress'] += len(outputs)
+                    
+                    created_files = [created[i] for i in sorted(created)]
+                    self.active_tasks[task_id]['files'] = created_files
+                    self.active_tasks[task_id]['sizes'] = [sizes[i] for i in sorted(sizes)]
+                    self.active_tasks[task_id]['last_accessed'] = datetime.now()
+            finally:
+                # Задача упала - остальные ее пачки больше не нужны
+                for batch_task in in_flight:
+                    batch_task.cancel()
             
             logger.info(f"Task {task_id}: created {len(created_files)} files")
+            queue_wait = self.active_tasks[task_id]['queue_wait']
+            if queue_wait:
+                logger.info(
+                    f"Task {task_id}: queue wait avg {queue_wait['total_seconds'] / queue_wait['items']:.1f}s, "
+                    f"max {queue_wait['max_seconds']:.1f}s"
+                )
             
             # Создаем архив со всеми файлами
             if created_files:
@@ -163,7 +478,7 @@ class VideoProcessor:
             if input_file.exists():
                 logger.info(f"Cleaning up input file: {input_file}")
                 cleanup_file(input_file)
-            
+        
         except Exception as e:
             logger.error(f"Task {task_id} failed: {str(e)}", exc_info=True)
             self.active_tasks[task_id].update({
@@ -175,6 +490,628 @@ class VideoProcessor:
             # Удаляем входной файл даже при ошибке
             if input_file.exists():
                 cleanup_file(input_file)
+        
+        finally:
+            if smart_renderer:
+                smart_renderer.cleanup()
+            if segment_encoder:
+                segment_encoder.cleanup()
+            if variant_assembler:
+                variant_assembler.cleanup()
+            if mezzanine_file:
+                cleanup_file(mezzanine_file)
+            if not keep_sources:
+                shutil.rmtree(task_dir / '.audio', ignore_errors=True)
+            shutil.rmtree(task_dir / '.twopass', ignore_errors=True)
+    
+    async def _encode_outputs(
+        self,
+        task_id: str,
+        source_file: Path,
+        outputs: List,
+        copies_count: int,
+        options: Dict,
+        units: float,
+        rank: float
+    ) -> Dict[int, bool]:
+        """
+        Кодирует пачку копий через общий пул: несколько копий - одним
+        процессом FFmpeg, одна - обычным способом. Пачка стоит в очереди
+        клиента задачи столько, сколько предсказывает модель стоимости,
+        а замеренное время калибрует модель
+        """
+        task = self.active_tasks[task_id]
+        key = self._cost_key(options, len(outputs))
+        schedule = {
+            'client': task['client'],
+            'cost': self.cost_model.predict(key, units, len(outputs)),
+            'stats': task['queue_wait'],
+            'priority': task['priority'],
+            'rank': rank,
+            'observe': partial(self.cost_model.observe, key, units, len(outputs)),
+            # Сегментированная копия кодирует все сегменты одновременно, пачка -
+            # столько копий, сколько в ней выходов (у каждой свой x264)
+            'weight': len(options['segment_encoder'].bounds) if options.get('segment_encoder') else len(outputs),
+        }
+        
+        if len(outputs) > 1:
+            return await self.encode_pool.run(
+                self.uniquifier.create_unique_batch,
+                source_file,
+                outputs,
+                copies_count,
+                options,
+                **schedule
+            )
+        
+        i, output_path = outputs[0]
+        success = await self.encode_pool.run(
+            self.uniquifier.create_unique_copy,
+            source_file,
+            output_path,
+            i,
+            copies_count,
+            options,
+            **schedule
+        )
+        return {i: success}
+    
+    async def _run_stage(self, task_id: str, func, *args, units: float = 0.0):
+        """
+        Подготовительная работа задачи с FFmpeg (замер декодирования и
+        мезонин, первый проход, пул аудио, варианты сегментов, нарезка smart
+        rendering и сегментов) в общем пуле наравне с копиями. Без
+        units стоимость и ранг минимальны: задача не начнется, пока
+        этап не закончится
+        """
+        task = self.active_tasks[task_id]
+        predicted = self.cost_model.predict('full', units)
+        return await self.encode_pool.run(
+            func,
+            *args,
+            client=task['client'],
+            cost=predicted,
+            stats=task['queue_wait'],
+            priority=task['priority'],
+            rank=predicted
+        )
+    
+    def _cost_key(self, options: Dict, copies: int = 1) -> str:
+        """
+        Ключ модели стоимости: режим задачи и способ кодирования копии
+        (сегменты загружают все ядра, пачка делит декодирование входа)
+        """
+        key = options['tier'].value
+        if options.get('segment_encoder'):
+            return f"{key}:segments"
+        if copies > 1:
+            return f"{key}:batch"
+        return key
+    
+    async def _prepare_stream_task(
+        self,
+        task_id: str,
+        input_file: Path,
+        task_dir: Path,
+        options: Dict
+    ):
+        """
+        Готовит задачу потоковой выдачи: вход переносится в директорию
+        задачи (живет и удаляется вместе с ней), пул аудио кодируется
+        один раз, копии кодируются только при запросе
+        """
+        source_file = await self._prepare_on_demand_source(task_id, input_file, task_dir, options)
+        
+        self.active_tasks[task_id].update({
+            'status': 'completed',
+            'tier': ProcessingTier.FULL,
+            'source_file': source_file,
+            'options': options,
+            'completed_at': datetime.now(),
+            'last_accessed': datetime.now(),
+        })
+        await asyncio.to_thread(self._save_manifest, task_id, task_dir)
+        logger.info(f"Task {task_id}: ready for streaming {self.active_tasks[task_id]['total']} copies")
+    
+    async def _prepare_lazy_task(
+        self,
+        task_id: str,
+        input_file: Path,
+        task_dir: Path,
+        output_format: str,
+        options: Dict
+    ):
+        """
+        Готовит задачу с отложенной сборкой: сохраняются только вход и
+        параметры всех копий (params.json), копия кодируется при первом
+        скачивании и попадает в LRU-кеш
+        """
+        source_file = await self._prepare_on_demand_source(task_id, input_file, task_dir, options)
+        total = self.active_tasks[task_id]['total']
+        
+        def save_params():
+            params = {
+                copy_number: self.uniquifier._prepare_copy_params(copy_number, total, options)
+                for copy_number in range(1, total + 1)
+            }
+            (task_dir / 'params.json').write_text(json.dumps(params, default=str))
+        
+        await asyncio.to_thread(save_params)
+        
+        self.active_tasks[task_id].update({
+            'status': 'completed',
+            'progress': total,
+            'tier': ProcessingTier.FULL,
+            'files': [f"video_{i:03d}.{output_format}" for i in range(1, total + 1)],
+            'source_file': source_file,
+            'options': options,
+            'completed_at': datetime.now(),
+            'last_accessed': datetime.now(),
+        })
+        await asyncio.to_thread(self._save_manifest, task_id, task_dir)
+        logger.info(f"Task {task_id}: stored parameters of {total} copies for on-demand encoding")
+    
+    async def _prepare_on_demand_source(
+        self,
+        task_id: str,
+        input_file: Path,
+        task_dir: Path,
+        options: Dict
+    ) -> Path:
+        """
+        Переносит вход в директорию задачи (живет и удаляется вместе
+        с ней) и один раз кодирует пул аудио для копий по запросу
+        """
+        source_file = task_dir / f".source{input_file.suffix}"
+        await asyncio.to_thread(shutil.move, str(input_file), str(source_file))
+        
+        # По запросу копии собираются только полным перекодированием
+        options['tier'] = ProcessingTier.FULL
+        options['audio_pool'] = await self._prepare_audio_pool(
+            task_id, source_file, task_dir / '.audio', options['window']
+        )
+        return source_file
+    
+    async def materialize_copy(self, task_id: str, filename: str) -> Optional[Path]:
+        """
+        Возвращает копию задачи с отложенной сборкой, при необходимости
+        кодируя ее по сохраненным параметрам. Задача и параметры читаются
+        с диска, если задачи нет в памяти. Копия закреплена в кеше, пока
+        ее не отпустят через release_copy. None если задача не в этом
+        режиме, еще не готова или такой копии нет
+        
+        Raises:
+            RuntimeError: копию не удалось собрать
+        """
+        task = self.get_on_demand_task(task_id)
+        if not task or task.get('delivery') != Delivery.LAZY or task['status'] != 'completed':
+            return None
+        if filename not in task['files']:
+            return None
+        
+        output_path = Path(task['task_dir']) / filename
+        # Одну копию параллельные запросы собирают один раз. Блокировка
+        # удаляется, когда ее никто не держит и не ждет
+        entry = self.materialize_locks.setdefault(output_path, {'lock': asyncio.Lock(), 'users': 0})
+        entry['users'] += 1
+        try:
+            async with entry['lock']:
+                path = await self._materialize(task_id, task, filename, output_path)
+                self.copy_cache.pin(path)
+                return path
+        finally:
+            entry['users'] -= 1
+            if not entry['users']:
+                del self.materialize_locks[output_path]
+    
+    def release_copy(self, path: Path):
+        """Копия отдана клиенту - кеш снова может ее вытеснить"""
+        self.copy_cache.unpin(path)
+    
+    async def _materialize(self, task_id: str, task: Dict, filename: str, output_path: Path) -> Path:
+        """
+        Собирает копию, если ее еще нет на диске. Копия пишется во
+        временный файл и переименовывается, поэтому готовый путь всегда
+        указывает на целую копию, даже если ее собрал другой процесс
+        """
+        if output_path.exists():
+            # Копию мог собрать другой процесс - берем ее в свой кеш
+            if not self.copy_cache.touch(output_path):
+                self.copy_cache.add(output_path)
+            return output_path
+        
+        copy_number = int(COPY_FILENAME.match(filename).group(1))
+        params_file = Path(task['task_dir']) / 'params.json'
+        params = json.loads(await asyncio.to_thread(params_file.read_text))[str(copy_number)]
+        
+        logger.info(f"Task {task_id}: encoding {filename} on demand")
+        partial_path = output_path.with_name(f".{uuid.uuid4().hex}_{filename}")
+        predicted = self.cost_model.predict('full', params['estimated_cost'])
+        success = await self.encode_pool.run(
+            self.uniquifier.create_copy_from_params,
+            task['source_file'],
+            partial_path,
+            params,
+            task['options'],
+            client=task['client'],
+            cost=predicted,
+            stats=task['queue_wait'],
+            priority=task['priority'],
+            rank=predicted,
+            observe=partial(self.cost_model.observe, 'full', params['estimated_cost'], 1)
+        )
+        if not success or not partial_path.exists():
+            logger.error(f"Failed to create {filename} on demand")
+            cleanup_file(partial_path)
+            raise RuntimeError(f"Failed to create {filename} on demand")
+        
+        await asyncio.to_thread(os.replace, partial_path, output_path)
+        self.copy_cache.add(output_path)
+        logger.info(
+            f"Task {task_id}: {filename} ready, {output_path.stat().st_size} bytes, "
+            f"cache {self.copy_cache.total_bytes} bytes"
+        )
+        return output_path
+    
+    def _save_manifest(self, task_id: str, task_dir: Path):
+        """
+        Сохраняет все, что нужно для выдачи копий по запросу, в
+        manifest.json задачи: запрос может прийти в процесс, который
+        задачу не создавал, или после перезапуска
+        """
+        task = self.active_tasks[task_id]
+        manifest = {
+            'delivery': task['delivery'],
+            'total': task['total'],
+            'priority': task['priority'],
+            'client': task['client'],
+            'output_format': task['output_format'],
+            'source_file': str(task['source_file']),
+            'created_at': task['created_at'].isoformat(),
+            'options': {key: task['options'].get(key) for key in MANIFEST_OPTIONS},
+        }
+        (task_dir / 'manifest.json').write_text(json.dumps(manifest, default=str))
+    
+    def get_on_demand_task(self, task_id: str) -> Optional[Dict]:
+        """
+        Задача потоковой или отложенной выдачи: из памяти, а если ее там
+        нет - из манифеста в директории задачи
+        """
+        task = self.get_task_status(task_id)
+        if task:
+            return task
+        
+        manifest_file = settings.output_dir / task_id / 'manifest.json'
+        if not manifest_file.exists():
+            return None
+        
+        try:
+            manifest = json.loads(manifest_file.read_text())
+            options = manifest['options']
+            options.update({
+                'tier': ProcessingTier(options['tier']),
+                'speed_class': SpeedClass(options['speed_class']),
+                'profile': OutputProfile(options['profile']),
+                'audio_pool': [Path(path) for path in options['audio_pool'] or []],
+            })
+            delivery = Delivery(manifest['delivery'])
+            total = manifest['total']
+            task = {
+                'status': 'completed',
+                'progress': total,
+                'total': total,
+                'tier': options['tier'],
+                'speed_class': options['speed_class'],
+                'rate_control': RateControl.CRF,
+                'output_profile': options['profile'],
+                'delivery': delivery,
+                'files': (
+                    [f"video_{i:03d}.{manifest['output_format']}" for i in range(1, total + 1)]
+                    if delivery == Delivery.LAZY else []
+                ),
+                'sizes': [],
+                'created_at': datetime.fromisoformat(manifest['created_at']),
+                'last_accessed': datetime.now(),
+                'task_dir': str(settings.output_dir / task_id),
+                'output_format': manifest['output_format'],
+                'client': manifest['client'],
+                'queue_wait': {},
+                'priority': PriorityClass(manifest['priority']),
+                'source_file': Path(manifest['source_file']),
+                'options': options,
+            }
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Could not load manifest of task {task_id}: {str(e)}")
+            return None
+        
+        self.active_tasks[task_id] = task
+        logger.info(f"Task {task_id}: restored from manifest")
+        return task
+    
+    async def stream_copy(self, task_id: str, copy_number: int) -> Optional[AsyncIterator[bytes]]:
+        """
+        Кодирует копию во фрагментированный MP4 и отдает ее кусками по мере
+        готовности. FFmpeg запускается в слоте общего пула, как и любое
+        другое кодирование. None если задача не потоковая или еще не готова
+        """
+        task = self.get_on_demand_task(task_id)
+        if not task or task.get('delivery') != Delivery.STREAM or task['status'] != 'completed':
+            return None
+        
+        command = self.uniquifier.build_stream_command(
+            task['source_file'],
+            copy_number,
+            task['total'],
+            task['options']
+        )
+        units = self.uniquifier._generate_copy_params(copy_number, task['total'], task['options'])['estimated_cost']
+        predicted = self.cost_model.predict('full', units)
+        
+        # Куски stdout передаются в цикл событий без потоков executor; семафор
+        # ограничивает, сколько кусков ждет медленного клиента
+        chunks: asyncio.Queue = asyncio.Queue()
+        credits = threading.Semaphore(STREAM_QUEUE_CHUNKS)
+        stop = threading.Event()
+        pump = asyncio.create_task(self.encode_pool.run(
+            self._pump_stream,
+            command,
+            asyncio.get_running_loop(),
+            chunks,
+            credits,
+            stop,
+            client=task['client'],
+            cost=predicted,
+            stats=task['queue_wait'],
+            priority=task['priority'],
+            rank=predicted
+        ))
+        # Работа снята с очереди или упала - поток тоже закончен
+        pump.add_done_callback(lambda _: chunks.put_nowait(None))
+        
+        async def stream():
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    credits.release()
+                    yield chunk
+            finally:
+                # Клиент отключился - останавливаем кодирование или снимаем
+                # копию с очереди пула
+                stop.set()
+                pump.cancel()
+        
+        return stream()
+    
+    def _pump_stream(
+        self,
+        command: List[str],
+        loop: asyncio.AbstractEventLoop,
+        chunks: asyncio.Queue,
+        credits: threading.Semaphore,
+        stop: threading.Event
+    ):
+        """
+        Выполняется в слоте пула: запускает FFmpeg и передает его stdout
+        в очередь цикла событий до конца кодирования или отключения
+        клиента. Кусок уходит сразу, как только FFmpeg его записал
+        """
+        process = None
+        try:
+            process = subprocess.Popen(
+                with_priority(command),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            while not stop.is_set():
+                chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                # Ждем, пока клиент заберет кусок из очереди
+                while not credits.acquire(timeout=1):
+                    if stop.is_set():
+                        return
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+        finally:
+            if process:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+    
+    def _plan_window(
+        self,
+        media: Dict,
+        start: Optional[float],
+        duration: Optional[float]
+    ) -> Optional[Dict]:
+        """
+        Окно (фрагмент) входа из start/duration запроса, обрезанное по
+        длительности входа. None если обрабатывается весь файл
+        """
+        if start is None and duration is None:
+            return None
+        
+        start = start or 0.0
+        if media['duration'] <= 0:
+            raise Exception("Длительность видео неизвестна, фрагмент вырезать нельзя")
+        if start >= media['duration']:
+            raise Exception("Начало фрагмента за пределами видео")
+        
+        available = media['duration'] - start
+        return {'start': start, 'duration': min(duration or available, available)}
+    
+    async def _prepare_mezzanine(
+        self,
+        task_id: str,
+        input_file: Path,
+        media: Dict,
+        copies_count: int,
+        tier: ProcessingTier,
+        window: Optional[Dict] = None
+    ) -> Optional[Path]:
+        """
+        Создает промежуточный FFV1 на scratch-диске, если по замеру
+        скорости декодирования это окупится для данного числа проходов
+        """
+        try:
+            # Сколько раз копии задачи декодировали бы исходник
+            if tier == ProcessingTier.COMBINATORIAL:
+                decode_passes = max(2, math.ceil(copies_count ** (1 / settings.variant_max_segments)))
+            elif plan_segment_count(media['duration']) >= 2:
+                decode_passes = copies_count
+            else:
+                decode_passes = math.ceil(copies_count / max(1, settings.encode_batch_size))
+            
+            # Замер скорости декодирования - тоже полноскоростное декодирование
+            if not await self._run_stage(task_id, should_use_mezzanine, media, input_file, decode_passes):
+                return None
+            
+            mezzanine_file = settings.scratch_dir / f"{task_id}_mezzanine.mkv"
+            logger.info(f"Task {task_id}: decoding input once into {mezzanine_file}")
+            
+            if await self._run_stage(task_id, create_mezzanine, input_file, mezzanine_file, window):
+                return mezzanine_file
+        
+        except Exception as e:
+            logger.error(f"Mezzanine stage failed: {str(e)}")
+        
+        return None
+    
+    async def _prepare_first_pass(
+        self,
+        task_id: str,
+        source_file: Path,
+        media: Dict,
+        speed_class: SpeedClass,
+        target_bitrate_kbps: Optional[int],
+        output_profile: OutputProfile,
+        output_format: str,
+        window: Optional[Dict],
+        work_dir: Path
+    ) -> Optional[Dict]:
+        """
+        Общий первый проход x264, None если он не удался
+        """
+        try:
+            two_pass = self.uniquifier.plan_two_pass(
+                media, speed_class, target_bitrate_kbps, output_profile, output_format
+            )
+            logger.info(f"Task {task_id}: first pass at {two_pass['video_bitrate_kbps']} kbps")
+            return await self._run_stage(
+                task_id,
+                self.uniquifier.create_first_pass,
+                source_file,
+                work_dir,
+                two_pass,
+                window
+            )
+        except Exception as e:
+            logger.error(f"First pass failed: {str(e)}")
+            return None
+    
+    async def _prepare_audio_pool(
+        self,
+        task_id: str,
+        source_file: Path,
+        work_dir: Path,
+        window: Optional[Dict] = None
+    ) -> List[Path]:
+        """
+        Кодирует пул вариантов аудио, пустой список если аудио нет
+        или пул отключен
+        """
+        if settings.audio_pool_size < 1:
+            return []
+        
+        try:
+            media = await asyncio.to_thread(analyze_media, source_file)
+            if not media['has_audio']:
+                return []
+            
+            audio_pool = await self._run_stage(
+                task_id,
+                self.uniquifier.create_audio_pool,
+                source_file,
+                work_dir,
+                settings.audio_pool_size,
+                window
+            )
+            logger.info(f"Audio pool ready: {len(audio_pool)} variants")
+            return audio_pool
+        
+        except Exception as e:
+            logger.error(f"Audio pool failed, encoding audio per copy: {str(e)}")
+            return []
+    
+    async def _prepare_box_patcher(
+        self,
+        input_file: Path,
+        output_format: str
+    ) -> Optional[Mp4BoxPatcher]:
+        """
+        Разбирает дерево атомов входа один раз на задачу.
+        Возвращает None если вход или выходной формат не MP4/MOV
+        """
+        if input_file.suffix.lower() not in SUPPORTED_EXTENSIONS:
+            return None
+        if f".{output_format}".lower() not in SUPPORTED_EXTENSIONS:
+            return None
+        
+        try:
+            return await asyncio.to_thread(Mp4BoxPatcher, input_file)
+        except Exception as e:
+            logger.error(f"Could not parse MP4 boxes of {input_file}: {str(e)}")
+            return None
+    
+    async def _prepare_smart_renderer(self, task_id: str, smart_renderer: SmartRenderer) -> bool:
+        """
+        Проба ключевых кадров и нарезка общих кусков для smart rendering
+        """
+        try:
+            return await self._run_stage(task_id, smart_renderer.prepare)
+        except Exception as e:
+            logger.error(f"Smart render preparation failed: {str(e)}")
+            return False
+    
+    async def _prepare_segment_encoder(self, task_id: str, segment_encoder: ParallelSegmentEncoder) -> bool:
+        """
+        Выбор числа и границ сегментов по длительности входа и числу ядер
+        """
+        try:
+            return await self._run_stage(task_id, segment_encoder.prepare)
+        except Exception as e:
+            logger.error(f"Segment encoder preparation failed: {str(e)}")
+            return False
+    
+    async def _prepare_variant_assembler(self, task_id: str, variant_assembler: SegmentVariantAssembler) -> bool:
+        """
+        Кодирование всех вариантов сегментов для комбинаторной сборки,
+        каждый вариант - отдельная работа общего пула
+        """
+        try:
+            if not await self._run_stage(task_id, variant_assembler.prepare):
+                return False
+            
+            encodes = [
+                asyncio.create_task(self._run_stage(
+                    task_id,
+                    variant_assembler.encode_variant,
+                    *job,
+                    units=variant_assembler.variant_cost(job)
+                ))
+                for job in variant_assembler.jobs
+            ]
+            try:
+                await asyncio.gather(*encodes)
+            finally:
+                # Вариант не удался - остальные ждущие больше не нужны
+                for encode in encodes:
+                    encode.cancel()
+            return True
+        except Exception as e:
+            logger.error(f"Variant assembler preparation failed: {str(e)}")
+            return False
     
     async def _create_archive(
         self, 
@@ -217,7 +1154,7 @@ class VideoProcessor:
             await asyncio.to_thread(create_zip)
             
             return archive_path if archive_path.exists() else None
-            
+        
         except Exception as e:
             logger.error(f"Error creating archive: {str(e)}", exc_info=True)
             return None
@@ -269,6 +1206,7 @@ class VideoProcessor:
                         freed_space += dir_size
                         
                         shutil.rmtree(task_dir)
+                        self.copy_cache.discard_dir(task_dir)
                         logger.info(f"Cleaned up old task: {task_id}, freed {dir_size / (1024*1024):.2f} MB")
                         cleaned_count += 1
                     except Exception as e: